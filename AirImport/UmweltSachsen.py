@@ -16,18 +16,39 @@ STATIONS_ID = 'ctl00_Inhalt_StationList'
 STATIONS_KEY = 'ctl00$Inhalt$StationList'
 SUBSTANCES_ID  = 'ctl00_Inhalt_SchadstoffList'
 SUBSTANCES_KEY  = 'ctl00$Inhalt$SchadstoffList'
+TIME_ID = 'ctl00_Inhalt_LetzteList'
 TIME_KEY = 'ctl00$Inhalt$LetzteList'
 
+# Order of the form fields, changing one of them resets the following ones
+FORM_ORDER = [STATIONS_KEY, SUBSTANCES_KEY, AVERAGE_KEY, TIME_KEY]
+
+# Answers of ASP.NET when the form state of the session is gone or the
+# ViewState was not the one of its latest page
+SESSION_ERRORS = [
+    'Validation of viewstate MAC failed',
+    'The state information is invalid for this page',
+    'Invalid postback or callback argument',
+    'Invalid ViewState',
+]
+
+def is_session_error(text):
+    # Only pages are looked at, never a download
+    if text[:1] != '<':
+        return False
+    return any(error in text for error in SESSION_ERRORS)
+
 ACCURACY = [
     '45; 3600', # hours
     '21; 86400', # days
     '177; 1', # months
 ]
 
-def set_time_params(start, end):
+def set_time_params(start, end, last = 0):
+    # start may carry a day as third element, the month starts otherwise.
+    # A last option other than 0 ("last 24 hours" etc.) overrides both.
     return [
-        ('ctl00$Inhalt$LetzteList', 0),
-        ('ctl00$Inhalt$AZTag', '01'),
+        ('ctl00$Inhalt$LetzteList', last),
+        ('ctl00$Inhalt$AZTag', start[2] if len(start) > 2 else '01'),
         ('ctl00$Inhalt$AZMonat', start[1]),
         ('ctl00$Inhalt$AZJahr', start[0]),
         ('ctl00$Inhalt$EZTag', '01'),
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, datetime, json, hashlib
+from collections import deque
+import logging
+log = logging.getLogger('uws')
+
+try:
+    from . import reader
+except:
+    import reader
+
+# Aggregates of a joint city file CITY.csv are written to CITY.agg, a csv
+# with a row per day and substance and one per month and substance. What
+# is needed to continue with the rows added later is kept in
+# .aggregates.json of the same directory: the aggregates of the days before
+# the last one, the last hours of every substance and the length and hash
+# of the part of the file they were computed from.
+EXTENSION = '.agg'
+STATE = '.aggregates.json'
+HEADER = ['Datum', 'Stoff', 'Einheit', 'Mittel', 'Max8h', 'Max24h', 'Werte',
+    'Ueberschreitungen']
+HOUR = 3600
+DAY = 86400
+# Rolling means over (hours, values needed), 75% as in the EU rules
+WINDOWS = ((8, 6), (24, 18))
+# EU limits: hourly NO2 above 200 µg/m³ (hours), daily PM10 above 50 µg/m³
+# (days), highest 8 hour mean of O3 above 120 µg/m³ (days)
+LIMITS = dict(NO2 = ('hour', 200), PM10 = ('day', 50), O3 = ('8h', 120))
+
+def date_of(day):
+    return datetime.date.fromordinal(reader.EPOCH_DAY + day).isoformat()
+
+def sha1(f, length):
+    f.seek(0)
+    return hashlib.sha1(f.read(length)).hexdigest()
+
+def month_of(out_dir):
+    # YYYY/MM of a joint directory, None if it is not laid out like that
+    month, year = os.path.basename(out_dir), os.path.basename(
+        os.path.dirname(out_dir))
+    if year.isdigit() and month.isdigit():
+        return '{}/{}'.format(year, month)
+
+@attr.s
+class Aggregator(object):
+    # {substance: {YYYY-MM-DD: [sum, values, max 8h, max 24h, hours above]}}
+    days = attr.ib(default = attr.Factory(dict))
+    # {substance: deque of (time, value) of the last 24 hours}
+    tail = attr.ib(default = attr.Factory(dict))
+
+    def add(self, substance, t, timed, value):
+        # Hours belong to the day they end in, 24:00 to the day before
+        day = date_of((t - 1) // DAY if timed else t // DAY)
+        entry = self.days.setdefault(substance, {}).setdefault(day,
+            [0.0, 0, None, None, 0])
+        entry[0] += value
+        entry[1] += 1
+        if not timed:
+            return
+        window = self.tail.setdefault(substance, deque())
+        window.append((t, value))
+        while window[0][0] <= t - 24 * HOUR:
+            window.popleft()
+        for i, (hours, needed) in enumerate(WINDOWS):
+            values = [v for s, v in window if s > t - hours * HOUR]
+            if len(values) >= needed:
+                mean = sum(values) / len(values)
+                if entry[2 + i] is None or mean > entry[2 + i]:
+                    entry[2 + i] = mean
+        limit = LIMITS.get(substance)
+        if limit is not None and limit[0] == 'hour' and value > limit[1]:
+            entry[4] += 1
+
+    def snapshot(self):
+        return dict((s, [list(r) for r in w]) for s, w in self.tail.items())
+
+def update_city(path, state, previous, separator = ','):
+    # Aggregates of the joint file path, continuing from state where the
+    # file still starts with what state was computed from. previous are
+    # the last hours of the month before. Returns the new state.
+    aggregator = Aggregator(tail = dict((s, deque(tuple(r) for r in w))
+        for s, w in previous.items()))
+    with open(path, 'rb') as f:
+        substances = f.readline().decode('utf-8').rstrip('\n').split(
+            separator)[2:]
+        units = f.readline().decode('utf-8').rstrip('\n').split(
+            separator)[2:]
+        offset = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        if state is not None and state['previous'] == previous and \
+                state['offset'] <= size and \
+                sha1(f, state['offset']) == state['sha1']:
+            offset = state['offset']
+            aggregator.days = state['days']
+            aggregator.tail = dict((s, deque(tuple(r) for r in w))
+                for s, w in state['tail'].items())
+        elif state is not None:
+            log.debug('Aggregating %s from the start', path)
+
+        # Days before the last one are final, the file goes on from the
+        # start of the last day next time
+        f.seek(offset)
+        resume, tail, day, position = offset, aggregator.snapshot(), None, \
+            offset
+        for line in iter(f.readline, b''):
+            fields = line.decode('utf-8').rstrip('\n').split(separator)
+            if len(fields) < 2 or not fields[0]:
+                position += len(line)
+                continue
+            t = reader.seconds(fields[0], fields[1])
+            timed = bool(fields[1])
+            d = (t - 1) // DAY if timed else t // DAY
+            if d != day:
+                resume, tail, day = position, aggregator.snapshot(), d
+            for substance, value in zip(substances, fields[2:]):
+                if value:
+                    aggregator.add(substance, t, timed, float(value))
+            position += len(line)
+        last = date_of(day) if day is not None else None
+        prefix = sha1(f, resume)
+
+    return dict(
+        offset = resume,
+        sha1 = prefix,
+        previous = previous,
+        units = dict(zip(substances, units)),
+        days = aggregator.days,
+        # Days from the last one on are computed again next time
+        final = dict((s, dict((d, e) for d, e in days.items()
+                if last is None or d < last))
+            for s, days in aggregator.days.items()),
+        tail = tail,
+        end = aggregator.snapshot(),
+    )
+
+def rows(state):
+    # Rows of the aggregate file: days and months of every substance
+    def number(x):
+        return '' if x is None else '{:.2f}'.format(x)
+    out = []
+    for substance, days in sorted(state['days'].items()):
+        unit = state['units'].get(substance, '')
+        limit = LIMITS.get(substance)
+        months = {}
+        for day, (total, count, max8, max24, above) in sorted(days.items()):
+            mean = total / count
+            if limit is not None and limit[0] == 'day':
+                above = int(mean > limit[1])
+            elif limit is not None and limit[0] == '8h':
+                above = int(max8 is not None and max8 > limit[1])
+            out.append([day, substance, unit, number(mean), number(max8),
+                number(max24), str(count), str(above)])
+            m = months.setdefault(day[:7], [0.0, 0, None, None, 0])
+            m[0] += total
+            m[1] += count
+            for i in (2, 3):
+                x = (max8, max24)[i - 2]
+                if x is not None and (m[i] is None or x > m[i]):
+                    m[i] = x
+            m[4] += above
+        for month, (total, count, max8, max24, above) in sorted(
+                months.items()):
+            out.append([month, substance, unit, number(total / count),
+                number(max8), number(max24), str(count), str(above)])
+    return sorted(out, key = lambda r: (r[0][:7], r[1], r[0]))
+
+def month_dirs(out_dir):
+    # Directories of the months before and after out_dir, None if it is
+    # not laid out as YYYY/MM
+    month = month_of(os.path.abspath(out_dir))
+    if month is None:
+        return None, None
+    root = os.path.dirname(os.path.dirname(os.path.abspath(out_dir)))
+    return os.path.join(root, reader.previous_month(month)), \
+        os.path.join(root, reader.next_month(month))
+
+def update(out_dir, cities, separator = ','):
+    # Bring the aggregates of cities in out_dir up to date, returns the
+    # aggregate files written. separator is the one of the joint files,
+    # the aggregates are always written with ','. The state file is not
+    # returned, it only matters to the next run.
+    path = os.path.join(out_dir, STATE)
+    states = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            states = json.load(f)
+    ends = dict((city, states[city]['end']) for city in cities
+        if city in states)
+    # Last hours of the month before, for the rolling means of the first day
+    before = {}
+    previous_dir = month_dirs(out_dir)[0]
+    if previous_dir is not None and \
+            os.path.exists(os.path.join(previous_dir, STATE)):
+        with open(os.path.join(previous_dir, STATE), 'r') as f:
+            before = json.load(f)
+    written = []
+    for city in cities:
+        joint = os.path.join(out_dir, '{}.csv'.format(city))
+        if not os.path.exists(joint):
+            continue
+        state = states.get(city)
+        state = update_city(joint, None if state is None else dict(state,
+                days = state['final']),
+            before.get(city, {}).get('end', {}), separator)
+        states[city] = dict((k, v) for k, v in state.items() if k != 'days')
+        out = os.path.join(out_dir, '{}{}'.format(city, EXTENSION))
+        with open(out, 'w') as f:
+            f.write(','.join(HEADER) + '\n')
+            f.writelines(','.join(row) + '\n' for row in rows(state))
+        written.append(out)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(states, f, sort_keys = True)
+    os.replace(path + '.tmp', path)
+    return written + follow(out_dir, [city for city in cities
+        if city in states and states[city]['end'] != ends.get(city)],
+        separator)
+
+def follow(out_dir, cities, separator = ','):
+    # The rolling means of the next month start from the last hours of
+    # this one: aggregates of cities whose last hours changed are brought
+    # up to date there too, if that month was aggregated before
+    next_dir = month_dirs(out_dir)[1]
+    if not cities or next_dir is None or \
+            not os.path.exists(os.path.join(next_dir, STATE)):
+        return []
+    log.debug('Last hours of %s changed, aggregating %s again',
+        ', '.join(cities), next_dir)
+    return update(next_dir, [city for city in cities
+            if os.path.exists(os.path.join(next_dir, '{}.csv'.format(city)))],
+        separator)
+
+def forget(out_dir, cities, separator = ','):
+    # Drop the state of cities whose joint files are gone, returns the
+    # aggregate files of the next month written again
+    path = os.path.join(out_dir, STATE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        states = json.load(f)
+    gone = [city for city in cities if city in states]
+    if not gone:
+        return []
+    for city in gone:
+        states.pop(city)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(states, f, sort_keys = True)
+    os.replace(path + '.tmp', path)
+    return follow(out_dir, gone, separator)
+
+def cities_of(out_dir):
+    return sorted(name[:-len('.csv')] for name in os.listdir(out_dir)
+        if name.endswith('.csv') and not name.startswith('_'))
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.addHandler(StreamHandler(sys.stderr))
+    log.setLevel(logging.INFO)
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Writes CITY.agg next to every joint CITY.csv of the YYYY/MM subdirectories
+of --data-dir, month after month: for every day and substance the mean, the
+highest 8 and 24 hour rolling means, the number of values and how often the
+EU limit was exceeded (NO2: hours above 200 µg/m³, PM10: days above
+50 µg/m³, O3: days with an 8 hour mean above 120 µg/m³), and the same for
+the month.
+
+Only the rows added since the last run are read, unless a file changed
+before them. Cities whose last hours of a month changed are aggregated again
+in the next month as well, its rolling means start from them. The converter
+does the same for the cities it writes with --aggregates.
+""")
+
+    parser.add_option(
+        "-d", "--data-dir",
+        dest = "data_dir",
+        default = "data",
+        help = u"Directory of joint YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "-s", "--separator",
+        dest = "separator",
+        default = ",",
+        help = u"Separator of the joint files",
+    )
+    (options, arguments) = parser.parse_args()
+
+    for month in reader.Reader(data_dir = options.data_dir).months():
+        out_dir = os.path.join(options.data_dir, month)
+        update(out_dir, cities_of(out_dir), options.separator)
+        log.info('%s aggregated', month)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, time
+import asyncio
+import logging
+log = logging.getLogger('uws')
+
+import aiohttp
+
+try:
+    from . import UmweltSachsen as uws
+    from . import importer
+    from . import metrics
+    from . import transport
+except:
+    import UmweltSachsen as uws
+    import importer
+    import metrics
+    import transport
+
+@attr.s
+class AIMDLimiter(object):
+    # Number of requests allowed in flight, adjusted on every response:
+    # additive increase while the server answers fast, multiplicative
+    # decrease on errors or slow answers
+    limit = attr.ib(default = 2.0)
+    min_limit = attr.ib(default = 1)
+    max_limit = attr.ib(default = 16)
+    # Responses slower than this (in seconds) count as congestion
+    target_latency = attr.ib(default = 5.0)
+    increase = attr.ib(default = 1.0)
+    decrease = attr.ib(default = 0.5)
+
+    _in_flight = attr.ib(default = 0)
+    _cond = attr.ib(default = attr.Factory(asyncio.Condition))
+
+    def __attrs_post_init__(self):
+        # A single session (--workers 1) means a single request in flight
+        self.limit = min(self.max_limit, max(self.min_limit, self.limit))
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+
+    async def release(self, latency, error = False):
+        async with self._cond:
+            self._in_flight -= 1
+            if error or latency > self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                log.debug('Concurrency decreased to %d', self.limit)
+            else:
+                self.limit = min(self.max_limit,
+                    self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+@attr.s
+class RateLimiter(object):
+    # Like parallel.RateLimiter, for the sessions of one event loop
+    rate = attr.ib()
+
+    _next = attr.ib(default = 0.0)
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + 1.0 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+@attr.s
+class AsyncLuftOnlineSiteConfig(importer.LuftOnlineSiteConfig):
+    # Same station/substance/period flow as LuftOnlineSiteConfig, but every
+    # request is awaited on an aiohttp session
+    _session = attr.ib(default = None)
+
+    limiter = attr.ib(default = attr.Factory(AIMDLimiter))
+    # Optional RateLimiter shared by all sessions, waited for before every
+    # attempt
+    rate_limiter = attr.ib(default = None)
+    # Per request deadline in seconds
+    deadline = attr.ib(default = 45)
+    # Retries of failed requests, as in transport.Transport
+    retries = attr.ib(default = 3)
+    backoff = attr.ib(default = 0.5)
+    max_backoff = attr.ib(default = 30.0)
+
+    async def get_live_data(self, periods = [(2016, 9)]):
+        periods = list(periods)
+        try:
+            await self.load_stations()
+            for station in self.stations:
+                await self.get_station_data(station, periods)
+        finally:
+            self._flush_manifest()
+
+    async def get_station_data(self, station, periods):
+        if not self._has_work(station, periods):
+            return
+        await self.load_substances(station)
+        for substance in station.substances:
+            for start, end, day in self.plan(substance, periods):
+                self.set_period(start, end, day)
+                await self.load_substance_data(substance)
+                await self.get_csv_data()
+
+    async def load_stations(self):
+        if self.catalog is None or not self.catalog.is_fresh():
+            return await self.read_stations()
+        importer.LuftOnlineSiteConfig.load_stations(self)
+
+    async def read_stations(self):
+        log.info('Read stations')
+        self._form_state.clear()
+        self._set_stations(await self._get_string())
+
+    async def _start_session(self):
+        log.info('Start session')
+        self._form_state.clear()
+        page = await self._get_string()
+        self._set_last_options(page)
+        if self.catalog is not None:
+            self.catalog.check_stations(page.options(uws.STATIONS_ID))
+
+    async def load_substances(self, station):
+        if uws.VIEWSTATE not in self._post_data:
+            await self._start_session()
+        if self._select_station(station) or not station.substances:
+            self._update_substances(station, await self._get_string())
+
+    async def load_substance_data(self, substance):
+        self.substance = substance
+        if self._select_substance(substance):
+            page = await self._get_string()
+            if substance.accuracy is None or not self._catalog_is_fresh():
+                self._set_accuracy(substance, page)
+        if self._select_average(substance):
+            await self._get_string()
+        if self._select_time():
+            await self._get_string()
+
+    async def get_csv_data(self):
+        files = self._csv_files()
+        if files is None:
+            return
+        with metrics.timer('download_seconds'):
+            try:
+                self._save_csv(files, await self._get_string(raw = True))
+                metrics.inc('downloads_total', status = 'ok')
+            except:
+                self._save_error(files)
+                metrics.inc('downloads_total', status = 'error')
+            finally:
+                self._post_data.pop(uws.BUTTON, None)
+
+    async def _get_string(self, raw = False):
+        # Like LuftOnlineSiteConfig._get_string
+        kind = 'csv' if raw else 'page'
+        try:
+            saved = None
+            for attempt in range(self.replays + 1):
+                try:
+                    if attempt > 0:
+                        saved = saved or self._save_request()
+                        metrics.inc('retries_total', kind = 'replay')
+                        await self._replay(saved)
+                    text, size = await self._request(kind)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self.replays:
+                        raise
+                    log.warning('*** Request failed, replaying the form state')
+                    continue
+                if uws.is_session_error(text) and attempt < self.replays:
+                    log.warning('*** Session lost, replaying the form state')
+                    continue
+                break
+            self._count_response(kind, size)
+            if raw:
+                return text
+            return self._parse(text)
+        finally:
+            # Answered or not, the postback is over. Fields it left unknown
+            # are posted again next time.
+            self._pending = None
+
+    async def _request(self, kind):
+        # (text, size) of the answer, transient failures are sent again
+        # after transport.delay()
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                await self.rate_limiter.wait()
+            await self.limiter.acquire()
+            start = time.monotonic()
+            error = True
+            try:
+                async with self._session.post(self.url,
+                        data = {k: str(v) for k, v in self._post_data.items()},
+                        timeout = aiohttp.ClientTimeout(total = self.deadline)
+                        ) as response:
+                    if response.status not in transport.TRANSIENT_STATUS or \
+                            attempt == self.retries:
+                        response.raise_for_status()
+                        body = await response.read()
+                        self._count_saved(response, body, kind)
+                        error = False
+                        return body.decode(response.get_encoding()), len(body)
+                    reason = str(response.status)
+                    wait = transport.retry_after(response, transport.delay(
+                        attempt, self.backoff, self.max_backoff))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                reason = type(e).__name__
+                wait = transport.delay(attempt, self.backoff, self.max_backoff)
+            finally:
+                latency = time.monotonic() - start
+                await self.limiter.release(latency, error)
+                metrics.observe('http_request_seconds', latency, kind = kind)
+                if error:
+                    metrics.inc('http_requests_total', kind = kind,
+                        status = 'error')
+            log.warning('Request failed (%s), retrying in %.1f s', reason,
+                wait)
+            metrics.inc('retries_total', kind = 'request')
+            await asyncio.sleep(wait)
+
+    def _count_saved(self, response, body, kind):
+        # aiohttp decompresses on its own, the header has the wire size
+        length = response.headers.get('Content-Length', '')
+        if response.headers.get('Content-Encoding', '') == 'gzip' and \
+                length.isdigit():
+            metrics.inc('http_bytes_saved_total',
+                max(0, len(body) - int(length)), kind = kind)
+
+    async def _replay(self, saved):
+        # Like LuftOnlineSiteConfig._replay
+        for step in self._start_replay(saved):
+            self._replay_step(*step)
+            text, size = await self._request('page')
+            self._count_response('page', size)
+            self._parse(text)
+        self._end_replay(saved)
+
+    def _clear_cookies(self):
+        self._session.cookie_jar.clear()
+
+@attr.s
+class AsyncSiteConfig(object):
+    # Upper bound of sessions, the limiter decides how many are busy
+    sessions = attr.ib(default = 16)
+    # Requests per second allowed for all sessions together
+    rate = attr.ib(default = None)
+    deadline = attr.ib(default = 45)
+
+    max_months = attr.ib(default = 1)
+    manifest = attr.ib(default = None)
+    url = attr.ib(default = uws.URL)
+    catalog = attr.ib(default = None)
+    gaps = attr.ib(default = None)
+    use_archive = attr.ib(default = False)
+    retries = attr.ib(default = 3)
+    backoff = attr.ib(default = 0.5)
+    # Sessions a station is started again on after an error
+    session_retries = attr.ib(default = 1)
+    separator = attr.ib(default = ',')
+    # Paths changed by all sessions
+    written = attr.ib(default = attr.Factory(set))
+
+    basedir = attr.ib(default = attr.Factory(os.getcwd))
+
+    out_dir = attr.ib(default = attr.Factory(lambda: '.'))
+
+    def get_live_data(self, periods = [(2016, 9)]):
+        try:
+            asyncio.run(self._get_live_data(list(periods)))
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+
+    async def _get_live_data(self, periods):
+        limiter = AIMDLimiter(max_limit = self.sessions)
+        rate_limiter = RateLimiter(self.rate) if self.rate else None
+        async with aiohttp.ClientSession(
+                cookie_jar = aiohttp.CookieJar(unsafe = True)) as session:
+            site = self._new_site(session, limiter, rate_limiter)
+            await site.load_stations()
+
+        # A session handles all periods of a station in one go
+        work = asyncio.Queue()
+        for station in site.stations:
+            work.put_nowait((station.id, periods, 0))
+        log.info('Queued %d work items for up to %d sessions',
+            work.qsize(), self.sessions)
+
+        await asyncio.gather(*[self._work(work, limiter, rate_limiter)
+            for i in range(min(self.sessions, work.qsize()))])
+
+    def _new_site(self, session, limiter, rate_limiter):
+        return AsyncLuftOnlineSiteConfig(out_dir = self.out_dir,
+            basedir = self.basedir, session = session, limiter = limiter,
+            rate_limiter = rate_limiter, deadline = self.deadline,
+            max_months = self.max_months, manifest = self.manifest,
+            url = self.url, catalog = self.catalog, gaps = self.gaps,
+            use_archive = self.use_archive, written = self.written,
+            retries = self.retries, backoff = self.backoff,
+            separator = self.separator)
+
+    async def _work(self, work, limiter, rate_limiter):
+        # Each worker owns a cookie jar and thus its own ViewState chain
+        session = aiohttp.ClientSession(
+            cookie_jar = aiohttp.CookieJar(unsafe = True))
+        site = None
+        try:
+            while not work.empty():
+                station_id, periods, attempt = work.get_nowait()
+                try:
+                    if site is None:
+                        site = self._new_site(session, limiter, rate_limiter)
+                        await site.load_stations()
+                    station = [s for s in site.stations
+                        if s.id == station_id][0]
+                    await site.get_station_data(station, periods)
+                except Exception:
+                    log.exception('*** Error processing station %s',
+                        station_id)
+                    metrics.inc('session_errors_total')
+                    # Start over with a fresh session, the station included
+                    await session.close()
+                    session = aiohttp.ClientSession(
+                        cookie_jar = aiohttp.CookieJar(unsafe = True))
+                    site = None
+                    if attempt < self.session_retries:
+                        metrics.inc('retries_total', kind = 'session')
+                        work.put_nowait((station_id, periods, attempt + 1))
+        finally:
+            await session.close()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import os, json, gzip, hashlib
+import threading
+import logging
+log = logging.getLogger('uws')
+
+# Raw files can be kept as gzip objects named by the sha1 of their content
+# below raw/objects/ab/cdef...gz, every raw/YYYY/MM directory then holds an
+# index.json mapping file names to objects. A download with the same content
+# as before only points to the object already there.
+#
+# Paths keep the layout of plain files (raw/YYYY/MM/station,substance.csv):
+# the functions below read a plain file if there is one and the archived
+# object otherwise.
+INDEX = 'index.json'
+OBJECTS = 'objects'
+
+# Index files are read, changed and written by every session of a process
+_lock = threading.Lock()
+
+def objects_dir(month_dir):
+    return os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(month_dir))), OBJECTS)
+
+def object_path(month_dir, digest):
+    return os.path.join(objects_dir(month_dir), digest[:2],
+        '{}.gz'.format(digest[2:]))
+
+def load_index(month_dir):
+    path = os.path.join(month_dir, INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_index(month_dir, index):
+    path = os.path.join(month_dir, INDEX)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent = 1, sort_keys = True)
+    os.replace(path + '.tmp', path)
+
+def digest(path):
+    # sha1 of an archived file, None if it is not archived. Plain files
+    # always come first.
+    if os.path.exists(path):
+        return None
+    return load_index(os.path.dirname(path)).get(os.path.basename(path))
+
+def exists(path):
+    return os.path.exists(path) or digest(path) is not None
+
+def getmtime(path):
+    # Archived files share the time of their index
+    if os.path.exists(path):
+        return os.path.getmtime(path)
+    return os.path.getmtime(os.path.join(os.path.dirname(path), INDEX))
+
+def listdir(month_dir):
+    # Plain and archived files of a month
+    names = set(name for name in os.listdir(month_dir)
+        if name != INDEX and not name.endswith('.tmp') and
+            os.path.isfile(os.path.join(month_dir, name)))
+    return sorted(names | set(load_index(month_dir)))
+
+def open_text(path):
+    # Text stream of a plain or archived file, decompressed while reading
+    if os.path.exists(path):
+        return open(path, 'r')
+    d = digest(path)
+    if d is None:
+        raise FileNotFoundError(path)
+    return gzip.open(object_path(os.path.dirname(path), d), 'rt',
+        encoding = 'utf-8')
+
+def read(path):
+    # Content of a plain or archived file, None if there is none
+    if not exists(path):
+        return None
+    with open_text(path) as f:
+        return f.read()
+
+def write(path, data):
+    # Archive data as path, replacing a plain file of the same name.
+    # Returns the paths changed: the object if it is new, the index and
+    # the plain file removed.
+    changed = []
+    month_dir, name = os.path.split(path)
+    raw = data.encode('utf-8')
+    d = hashlib.sha1(raw).hexdigest()
+    obj = object_path(month_dir, d)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok = True)
+        # No file name or time in the header, the same content always
+        # gives the same bytes
+        tmp = '{}.{}.tmp'.format(obj, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            with gzip.GzipFile(filename = '', mode = 'wb', fileobj = f,
+                    mtime = 0) as z:
+                z.write(raw)
+        os.replace(tmp, obj)
+        changed.append(obj)
+    with _lock:
+        index = load_index(month_dir)
+        if index.get(name) != d:
+            index[name] = d
+            save_index(month_dir, index)
+            changed.append(os.path.join(month_dir, INDEX))
+    if os.path.exists(path):
+        os.remove(path)
+        changed.append(path)
+    return changed
+
+def pack(month_dir):
+    # Move the plain csv files of a month into the archive
+    names = [name for name in os.listdir(month_dir) if name.endswith('.csv')]
+    for name in names:
+        path = os.path.join(month_dir, name)
+        with open(path, 'r') as f:
+            write(path, f.read())
+    return len(names)
+
+def unpack(month_dir):
+    # Write the archived files of a month as plain files again
+    index = load_index(month_dir)
+    for name in index:
+        data = read(os.path.join(month_dir, name))
+        with open(os.path.join(month_dir, name), 'w') as f:
+            f.write(data)
+    if os.path.exists(os.path.join(month_dir, INDEX)):
+        os.remove(os.path.join(month_dir, INDEX))
+    return len(index)
+
+def collect_garbage(raw_dir, month_dirs):
+    # Remove objects no index of month_dirs points to anymore
+    used = set(d for month_dir in month_dirs
+        for d in load_index(month_dir).values())
+    removed = 0
+    root = os.path.join(raw_dir, OBJECTS)
+    if not os.path.exists(root):
+        return removed
+    for prefix in os.listdir(root):
+        for name in os.listdir(os.path.join(root, prefix)):
+            if prefix + name[:-len('.gz')] not in used:
+                os.remove(os.path.join(root, prefix, name))
+                removed += 1
+        if not os.listdir(os.path.join(root, prefix)):
+            os.rmdir(os.path.join(root, prefix))
+    return removed
+
+def month_dirs(raw_dir):
+    return sorted(os.path.join(raw_dir, year, month)
+        for year in os.listdir(raw_dir)
+        if year.isdigit() and os.path.isdir(os.path.join(raw_dir, year))
+        for month in os.listdir(os.path.join(raw_dir, year))
+        if os.path.isdir(os.path.join(raw_dir, year, month)))
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.addHandler(StreamHandler(sys.stderr))
+    log.setLevel(logging.INFO)
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Moves the raw csv files of all YYYY/MM subdirectories of --raw-dir into the
+archive (--pack) or back into plain files (--unpack). Objects no month
+points to anymore are removed afterwards.
+
+The importer writes to the archive with --archive, the converter and
+gaps.py read archived and plain files alike.
+""")
+
+    parser.add_option(
+        "-r", "--raw-dir",
+        dest = "raw_dir",
+        default = "raw",
+        help = u"Directory of raw YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "--pack",
+        action = 'store_true',
+        dest = "pack",
+        default = False,
+        help = u"Move plain files into the archive",
+    )
+    parser.add_option(
+        "--unpack",
+        action = 'store_true',
+        dest = "unpack",
+        default = False,
+        help = u"Write archived files as plain files again",
+    )
+
+    (options, arguments) = parser.parse_args()
+    dirs = month_dirs(options.raw_dir)
+    for month_dir in dirs:
+        if options.pack:
+            log.info('%s: %d files packed', month_dir, pack(month_dir))
+        elif options.unpack:
+            log.info('%s: %d files unpacked', month_dir, unpack(month_dir))
+    log.info('%d objects removed', collect_garbage(options.raw_dir,
+        [] if options.unpack else dirs))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import attr
+
+import json, struct
+from array import array
+import logging
+log = logging.getLogger('uws')
+
+try:
+    import numpy as np
+except ImportError:
+    # Reading and writing need it, importing this module does not
+    np = None
+
+# Binary form of a joint city file, written next to it as CITY.lqd. All
+# numbers are little endian.
+#
+#   offset  size        content
+#   0       4           magic b'LQD1'
+#   4       4           uint32 format version (1)
+#   8       4           uint32 number of rows R
+#   12      4           uint32 number of substance columns C
+#   16      4           uint32 length M of the metadata
+#   20      M           metadata, UTF-8 JSON:
+#                       {"city": ..., "substances": [...], "units": [...]}
+#   ...                 zero padding up to a multiple of 8
+#   T       8 * R       int64 timestamps, seconds since 1970-01-01 local
+#                       time, ascending. 24:00 is 00:00 of the next day.
+#   T+8R    4 * R * C   float32 values, column after column (C x R), NaN
+#                       where the CSV has no value
+#   ...     R           uint8, 1 if the row has a time of day, 0 for daily
+#                       and monthly values
+#
+# The columns are the substances of all cities of the directory, in the
+# order of the CSV header.
+MAGIC = b'LQD1'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII')
+EXTENSION = '.lqd'
+
+def epochs(timepoints):
+    # Timestamps and time of day flags of YYYY-MM-DD[ HH:MM] strings
+    days = np.array([t[:10] for t in timepoints],
+        dtype = 'datetime64[D]').astype('datetime64[s]').astype(np.int64)
+    timed = np.array([len(t) > 10 for t in timepoints], dtype = bool)
+    seconds = np.array([int(t[11:13]) * 3600 + int(t[14:16]) * 60
+        if len(t) > 10 else 0 for t in timepoints], dtype = np.int64)
+    return days + seconds, timed
+
+def write(path, city, substances, units, times, timed, values):
+    # values is a (substances x rows) array
+    rows = len(times)
+    meta = json.dumps(dict(city = city, substances = list(substances),
+        units = list(units)), ensure_ascii = False).encode('utf-8')
+    start = HEADER.size + len(meta)
+    padding = -start % 8
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, rows, len(substances), len(meta)))
+        f.write(meta)
+        f.write(b'\0' * padding)
+        f.write(np.asarray(times, dtype = '<i8').tobytes())
+        f.write(np.asarray(values, dtype = '<f4').reshape(
+            len(substances), rows).tobytes())
+        f.write(np.asarray(timed, dtype = np.uint8).tobytes())
+
+@attr.s
+class Writer(object):
+    # Collects rows as they are written to the CSV
+    path = attr.ib()
+    city = attr.ib()
+    substances = attr.ib()
+    units = attr.ib()
+
+    _times = attr.ib(default = attr.Factory(list))
+    _values = attr.ib(default = attr.Factory(lambda: array('f')))
+
+    def add(self, time, values):
+        self._times.append(time)
+        self._values.extend(float(v) if v else float('nan') for v in values)
+
+    def close(self):
+        times, timed = epochs(self._times)
+        values = np.frombuffer(self._values, dtype = np.float32).reshape(
+            len(self._times), len(self.substances)).T
+        write(self.path, self.city, self.substances, self.units,
+            times, timed, values)
+
+@attr.s
+class Table(object):
+    city = attr.ib()
+    substances = attr.ib()
+    units = attr.ib()
+    # Views into the memory mapped file
+    times = attr.ib()
+    timed = attr.ib()
+    values = attr.ib()
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, rows, columns, size = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a version {} {} file'.format(
+                    path, VERSION, MAGIC.decode()))
+            meta = json.loads(f.read(size).decode('utf-8'))
+        start = HEADER.size + size
+        start += -start % 8
+        data = np.memmap(path, dtype = np.uint8, mode = 'r')
+        end = start + 8 * rows
+        times = data[start:end].view('<i8')
+        values = data[end:end + 4 * rows * columns].view('<f4').reshape(
+            columns, rows)
+        end += 4 * rows * columns
+        timed = data[end:end + rows].view(bool)
+        return cls(city = meta['city'], substances = meta['substances'],
+            units = meta['units'], times = times, timed = timed,
+            values = values)
+
+    def column(self, substance):
+        return self.values[self.substances.index(substance)]
+
+    def between(self, start, end):
+        # Slice of the rows from start up to but excluding end, both given
+        # as numpy datetime64 or seconds since the epoch
+        start, end = [np.datetime64(t, 's').astype(np.int64)
+            if not isinstance(t, (int, np.integer)) else t
+            for t in (start, end)]
+        return slice(int(np.searchsorted(self.times, start, 'left')),
+            int(np.searchsorted(self.times, end, 'left')))
+
+    def dates(self):
+        return self.times.astype('datetime64[s]')
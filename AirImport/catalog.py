@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, datetime, json
+import threading
+import logging
+log = logging.getLogger('uws')
+
+@attr.s
+class Catalog(object):
+    # Stations, their substances and the best accuracy of every substance
+    # as last seen on the site, so that a run can plan its downloads before
+    # sending a single request
+    path = attr.ib()
+    # The station list is read again once it is older than this
+    ttl = attr.ib(default = datetime.timedelta(days = 7))
+    # Time the station list was last read
+    refreshed = attr.ib(default = None)
+    # [{id, name, substances: [{id, name, accuracy}] or None if unknown}]
+    stations = attr.ib(default = attr.Factory(list))
+
+    _lock = attr.ib(default = attr.Factory(threading.RLock))
+
+    @classmethod
+    def load(cls, path, ttl = datetime.timedelta(days = 7)):
+        catalog = cls(path = path, ttl = ttl)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            catalog.refreshed = data['refreshed']
+            catalog.stations = data['stations']
+        return catalog
+
+    def save(self):
+        with self._lock:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump(dict(refreshed = self.refreshed,
+                    stations = self.stations), f, indent = 1, sort_keys = True)
+            os.replace(tmp, self.path)
+
+    def is_fresh(self, now = None):
+        # Usable without reading the site: recent enough and the substances
+        # of every station known
+        if self.refreshed is None or not self.stations:
+            return False
+        refreshed = datetime.datetime.strptime(
+            self.refreshed[:19], '%Y-%m-%dT%H:%M:%S')
+        if (now or datetime.datetime.now()) - refreshed > self.ttl:
+            return False
+        return all(s['substances'] is not None for s in self.stations)
+
+    def expire(self):
+        with self._lock:
+            self.refreshed = None
+            self.save()
+
+    def set_stations(self, stations):
+        # stations is [(id, name)] as read from the station list, known
+        # substances of unchanged stations are kept
+        with self._lock:
+            known = dict(((s['id'], s['name']), s) for s in self.stations)
+            new = [known.get((id, name)) or dict(id = id, name = name,
+                substances = None) for id, name in stations]
+            if new != self.stations:
+                log.info('Station list changed: %d stations', len(new))
+            self.stations = new
+            self.refreshed = datetime.datetime.now().isoformat()
+            self.save()
+
+    def check_stations(self, stations):
+        # Expire the catalog if the site lists other stations than it
+        with self._lock:
+            if [(s['id'], s['name']) for s in self.stations] != \
+                    list(stations):
+                log.info('Station list differs from the catalog')
+                self.expire()
+                return False
+            return True
+
+    def set_substances(self, station_id, substances):
+        # substances is [(id, name)] as read after selecting the station
+        with self._lock:
+            station = self._station(station_id)
+            if station is None:
+                return
+            known = dict(((s['id'], s['name']), s)
+                for s in station['substances'] or [])
+            new = [known.get((id, name)) or dict(id = id, name = name,
+                accuracy = None) for id, name in substances]
+            if new != station['substances']:
+                log.info('Substances of %s changed', station['name'])
+                station['substances'] = new
+                self.save()
+
+    def substances(self, station_id):
+        # [{id, name, accuracy}] of a station, None if unknown
+        with self._lock:
+            station = self._station(station_id)
+            return None if station is None else station['substances']
+
+    def set_accuracy(self, station_id, substance_id, accuracy):
+        with self._lock:
+            station = self._station(station_id)
+            for substance in (station or {}).get('substances') or []:
+                if substance['id'] == substance_id and \
+                        substance['accuracy'] != accuracy:
+                    substance['accuracy'] = accuracy
+                    self.save()
+
+    def _station(self, station_id):
+        for station in self.stations:
+            if station['id'] == station_id:
+                return station
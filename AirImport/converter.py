@@ -2,17 +2,34 @@
 
 import attr
 
-import os
+import os, re
+import heapq
 import logging
 log = logging.getLogger('uws')
 
 from io import StringIO
+from concurrent.futures import ProcessPoolExecutor
 import requests
+try:
+    import numpy as np
+except ImportError:
+    # Only needed by columnar and binary output
+    np = None
 
 try:
     from . import UmweltSachsen as uws
+    from . import sources
+    from . import binary
+    from . import metrics
+    from . import archive
+    from . import aggregates
 except:
     import UmweltSachsen as uws
+    import sources
+    import binary
+    import metrics
+    import archive
+    import aggregates
 
 def is_safe_path(basedir, path, follow_symlinks=True):
     # resolves symbolic links
@@ -22,6 +39,86 @@ def is_safe_path(basedir, path, follow_symlinks=True):
 
 separator = ','
 
+def read_header(buf):
+    # Since this script deals with both csv from Umwelt Sachsen
+    # and data from the importer, we need to autodetect the file separator
+    file_separator = ';'
+    header = buf.readline()
+    if len(header.split(file_separator)) == 1:
+        file_separator = ','
+    # Get headers (City names, substances, units)
+    header = header.split(file_separator)
+    units_row = buf.readline().split(file_separator)
+    city_names = [
+        ' '.join(txt.split(' ')[:-1]).strip() for txt in header[1:]]
+    substances = [txt.split(' ')[-1].strip() for txt in header[1:]]
+    units = [txt.strip() for txt in units_row[1:]]
+    return file_separator, city_names, substances, units
+
+def read_rows(buf, file_separator):
+    # Stripped fields of every data row, the time formatted as YYYY-MM-DD
+    for l in buf:
+        if not l.strip():
+            continue
+        l = l.replace('n. def.', '')
+        l = [txt.strip() for txt in l.split(file_separator)]
+        l[0] = parse_time(l[0])
+        yield l
+
+def parse_time(time):
+    # Take care of monthly generated data as it appears "09-2016"
+    if len(time) < 8:
+        time = '01-{}-{}'.format(time[:2],time[5:])
+    # Format to YYYY-MM-DD
+    return '-'.join(['20' + time[6:8], time[3:5], time[:2]]) + time[8:]
+
+def parse_epochs(times):
+    # Vectorized version of parse_time: seconds since the epoch and whether
+    # the row has a time of day. 24:00 becomes 00:00 of the next day.
+    times = np.array(times, dtype = 'U14')
+    lengths = np.char.str_len(times)
+    digits = times.view(np.uint32).reshape(-1, 14).astype(np.int64) - 48
+    def number(i):
+        return digits[:, i] * 10 + digits[:, i + 1]
+    monthly = lengths < 8
+    # Monthly data appears as "09-2016"
+    day = np.where(monthly, 1, number(0))
+    month = np.where(monthly, number(0), number(3))
+    year = np.where(monthly, number(5), number(6))
+    days = (np.datetime64('2000-01', 'M') + (year * 12 + month - 1)).astype(
+        'datetime64[D]') + (day - 1)
+    timed = lengths > 8
+    seconds = np.where(timed, number(9) * 3600 + number(12) * 60, 0)
+    return days.astype('datetime64[s]').astype(np.int64) + seconds, timed
+
+# Rows of a joint file made into strings at once by the columnar writer
+WRITE_ROWS = 1 << 14
+
+def format_values(values, decimals):
+    # Strings of float values, with a fixed number of decimals or, if
+    # decimals is None, the shortest ones reading back the same ("12",
+    # "12.5")
+    if decimals is not None:
+        return ['%.*f' % (decimals, v) for v in values.tolist()]
+    return [v[:-2] if v.endswith('.0') else v
+        for v in map(repr, values.tolist())]
+
+def parse_values(strings):
+    # float64 values of a list of strings and how to write them back as
+    # they are: the decimals for format_values(), or the strings themselves
+    # if no format gives them back
+    try:
+        values = np.fromiter(map(float, strings), np.float64, len(strings))
+    except ValueError:
+        return np.full(len(strings), np.nan), np.array(strings, dtype = str)
+    dot = strings[0].find('.')
+    for decimals in (0 if dot < 0 else len(strings[0]) - dot - 1, None):
+        # The first values rule out a format quickly
+        if format_values(values[:64], decimals) == strings[:64] and \
+                format_values(values, decimals) == strings:
+            return values, decimals
+    return values, np.array(strings, dtype = str)
+
 @attr.s
 class CityData(object):
     name = attr.ib()
@@ -29,6 +126,26 @@ class CityData(object):
     units = attr.ib(default = attr.Factory(list))
     data = attr.ib(default = attr.Factory(dict))
 
+@attr.s
+class Series(object):
+    # Values of a substance, kept as the arrays of every file read: float64
+    # values and, per file, the format of parse_values() to write them
+    # back as they were read
+    unit = attr.ib()
+    times = attr.ib(default = attr.Factory(list))
+    timed = attr.ib(default = attr.Factory(list))
+    values = attr.ib(default = attr.Factory(list))
+    formats = attr.ib(default = attr.Factory(list))
+
+@attr.s
+class ColumnarCityData(object):
+    name = attr.ib()
+    substances = attr.ib(default = attr.Factory(list))
+    units = attr.ib(default = attr.Factory(list))
+    series = attr.ib(default = attr.Factory(dict))
+    # Whether the end of the day was written as 24:00 instead of 00:00
+    midnight_24 = attr.ib(default = False)
+
 @attr.s
 class Conversor(object):
     cities = attr.ib(default = attr.Factory(dict))
@@ -36,35 +153,46 @@ class Conversor(object):
 
     basedir = attr.ib(default = attr.Factory(os.getcwd))
     out_dir = attr.ib(default = attr.Factory(lambda: 'data'))
+    # Merge files row by row instead of loading them into memory
+    streaming = attr.ib(default = False)
+    # Keep values in numpy arrays instead of dicts of strings
+    columnar = attr.ib(default = False)
+    # Number of processes parsing files and writing cities
+    processes = attr.ib(default = 1)
+    # Only rewrite the cities whose raw files changed since the last run
+    incremental = attr.ib(default = False)
+    # Also write every city in the binary format of binary.py
+    binary = attr.ib(default = False)
+    # Keep daily and monthly aggregates next to every city, see aggregates.py
+    aggregates = attr.ib(default = False)
+    # Paths of the files written, for publishing just those
+    written = attr.ib(default = attr.Factory(list))
+
+    def __attrs_post_init__(self):
+        if np is None and (self.columnar or self.binary):
+            raise ImportError('numpy is needed for columnar and binary output')
     
     def convert_csv_part(self, buf):
+        with metrics.timer('convert_part_seconds'):
+            if self.columnar:
+                rows = self.convert_csv_part_columnar(buf)
+            else:
+                rows = self.convert_csv_part_dict(buf)
+        metrics.inc('rows_parsed_total', rows)
+
+    def convert_csv_part_dict(self, buf):
+        # Returns the number of rows read
+        rows = 0
         cities = self.cities
-        # Since this script deals with both csv from Umwelt Sachsen
-        # and data from the importer, we need to autodetect the file separator
-        file_separator = ';'
-        header = buf.readline()
-        if len(header.split(file_separator)) == 1:
-            file_separator = ','
-        # Get headers (City names, substances, units)
-        header = header.split(file_separator)
-        units_row = buf.readline().split(file_separator)
-        city_names = [
-            ' '.join(txt.split(' ')[:-1]).strip() for txt in header[1:]]
-        substances = [txt.split(' ')[-1].strip() for txt in header[1:]]
-        units = [txt.strip() for txt in units_row[1:]]
+        file_separator, city_names, substances, units = read_header(buf)
         # Ensure there is a CityData entry for each city
         for city in city_names:
             if not cities.get(city, False):
                 cities[city] = CityData(name = city)
         # Parse data
-        for l in buf:
-            l = l.replace('n. def.', '')
-            l = [txt.strip() for txt in l.split(file_separator)]
-            # Take care of monthly generated data as it appears "09-2016"
-            if len(l[0]) < 8:
-                l[0] = '01-{}-{}'.format(l[0][:2],l[0][5:])
-            # Format to YYYY-MM-DD
-            time = '-'.join(['20' + l[0][6:8], l[0][3:5], l[0][:2]]) + l[0][8:]
+        for l in read_rows(buf, file_separator):
+            time = l[0]
+            rows += 1
               
             for city, substance, us, v in zip(
                     city_names, substances, units, l[1:]):
@@ -79,16 +207,183 @@ class Conversor(object):
                     cities[city].data[substance] = dict()
                 # Add value
                 cities[city].data[substance][time] = v.replace(',', '.')
+        return rows
     
+    def convert_csv_part_columnar(self, buf):
+        cities = self.cities
+        file_separator, city_names, substances, units = read_header(buf)
+        for city in city_names:
+            if not cities.get(city, False):
+                cities[city] = ColumnarCityData(name = city)
+        # Parse the whole file at once
+        text = buf.read().replace('n. def.', '')
+        if file_separator != ',':
+            text = text.replace(',', '.')
+        # Lines as iterating over buf gives them, without blank ones
+        lines = re.sub(r'(?m)^\s*\n', '', text).split('\n')
+        if lines and not lines[-1].strip():
+            lines.pop()
+        if not lines:
+            return 0
+        width = len(city_names) + 1
+        joined = file_separator.join(lines)
+        cells = joined.split(file_separator)
+        if len(cells) != len(lines) * width:
+            # Rows of different length, pad them one by one
+            cells = [c for l in lines
+                for c in (l.split(file_separator) + [''] * width)[:width]]
+        if ' ' + file_separator in joined or file_separator + ' ' in joined \
+                or joined[:1].isspace() or joined[-1:].isspace() or \
+                '\t' in joined or '\r' in joined:
+            cells = [c.strip() for c in cells]
+        times = cells[0::width]
+        times, timed = parse_epochs(times)
+        midnight_24 = '24:00' in text
+
+        for i, (city, substance, us) in enumerate(
+                zip(city_names, substances, units)):
+            column = cells[i + 1::width]
+            has_data = np.fromiter(map(bool, column), bool, len(column))
+            # Ignore columns without data
+            if not has_data.any():
+                continue
+            values, format = parse_values([v for v in column if v])
+            city = cities[city]
+            city.midnight_24 = city.midnight_24 or midnight_24
+            if substance not in city.substances:
+                city.substances.append(substance)
+                self.substances.add((substance, us))
+                city.units.append(us)
+                city.series[substance] = Series(unit = us)
+            series = city.series[substance]
+            series.times.append(times[has_data])
+            series.timed.append(timed[has_data])
+            series.values.append(values)
+            series.formats.append(format)
+        return len(lines)
+
+    def write_csv_columnar(self, city):
+        # Returns the number of rows written
+        f = self._open_csv(city.name)
+        if f is None:
+            return 0
+        substances = sorted(self.substances)
+
+        # Sort rows without time the same way the text timestamps sorted:
+        # "2016-09-01" before "2016-09-01 00:00" but after "...-31 24:00"
+        def keys(times, timed):
+            return times * 2 + (timed != city.midnight_24)
+        columns = dict()
+        for name, series in city.series.items():
+            k = keys(np.concatenate(series.times),
+                np.concatenate(series.timed))
+            v = np.concatenate(series.values)
+            # File and position in it of every value
+            lengths = [len(x) for x in series.values]
+            part = np.repeat(np.arange(len(lengths)), lengths)
+            position = np.arange(len(v)) - np.repeat(
+                np.cumsum([0] + lengths[:-1]), lengths)
+            # Later files overwrite earlier ones
+            k, last = np.unique(k[::-1], return_index = True)
+            last = len(v) - 1 - last
+            columns[name] = (k, v[last], part[last], position[last],
+                series.formats)
+        index = np.unique(np.concatenate([c[0] for c in columns.values()])) \
+            if columns else np.zeros(0, dtype = np.int64)
+
+        # Align every substance on the joint index
+        matrix = np.full((len(substances), len(index)), np.nan)
+        for j, s in enumerate(substances):
+            if s[0] in columns:
+                k = columns[s[0]][0]
+                columns[s[0]] = (np.searchsorted(index, k),) + \
+                    columns[s[0]][1:]
+                matrix[j, columns[s[0]][0]] = columns[s[0]][1]
+
+        times = index // 2
+        timed = (index % 2).astype(bool) != city.midnight_24
+        if self.binary:
+            self.written.append(self._binary_path(city.name))
+            binary.write(self._binary_path(city.name), city.name,
+                [s[0] for s in substances], [s[1] for s in substances],
+                times, timed, matrix)
+        end_of_day = timed & city.midnight_24 & (times % 86400 == 0)
+        # Strings are only made for a block of rows at a time, the values
+        # of a file are formatted together
+        for lo in range(0, len(index), WRITE_ROWS):
+            hi = min(lo + WRITE_ROWS, len(index))
+            table = []
+            for s in substances:
+                column = np.full(hi - lo, '', dtype = object)
+                table.append(column)
+                if s[0] not in columns:
+                    continue
+                rows, v, part, position, formats = columns[s[0]]
+                a, b = np.searchsorted(rows, (lo, hi))
+                rows, v, part, position = rows[a:b] - lo, v[a:b], \
+                    part[a:b], position[a:b]
+                for p in np.unique(part).tolist():
+                    mine = part == p
+                    if isinstance(formats[p], np.ndarray):
+                        column[rows[mine]] = formats[p][position[mine]]
+                    else:
+                        column[rows[mine]] = format_values(v[mine],
+                            formats[p])
+            stamps = np.datetime_as_string((times[lo:hi] -
+                    end_of_day[lo:hi] * 86400).astype('datetime64[s]'),
+                unit = 'm')
+            # YYYY-MM-DDTHH:MM, cut into date and time
+            dates = stamps.astype('U10')
+            hours = stamps.astype('U16').view('U1').reshape(-1, 16)[
+                :, 11:].copy().view('U5').reshape(-1)
+            hours = np.where(end_of_day[lo:hi], '24:00',
+                np.where(timed[lo:hi], hours, ''))
+            f.write('\n'.join(map(separator.join, zip(dates.tolist(),
+                hours.tolist(), *(c.tolist() for c in table)))) + '\n')
+        f.close()
+        return len(index)
+
     def write_csv(self, city):
+        with metrics.timer('write_seconds'):
+            if self.columnar:
+                rows = self.write_csv_columnar(city)
+            else:
+                rows = self.write_csv_dict(city)
+        metrics.inc('rows_written_total', rows)
+
+    def write_csv_dict(self, city):
+        # Returns the number of rows written
+        f = self._open_csv(city.name)
+        if f is None:
+            return 0
+ 
+        substances = sorted(self.substances)
+
+        # Get all timepoints used for this city
+        timepoints = set()
+        for y in [city.data[x].keys() for x in city.substances]:
+            timepoints = timepoints.union(y)
+        timepoints = sorted(timepoints)
+        # Write data
+        out = self._open_binary(city.name)
+        for t in timepoints:
+            vs = [city.data.get(s[0], dict()).get(t, '') for s in substances]
+            self._write_row(f, t, vs, out)
+        f.close()
+        if out is not None:
+            out.close()
+        return len(timepoints)
+
+    def _open_csv(self, name):
         # Ensure file is in writable path
-        file = '{}/{}.csv'.format(self.out_dir, city.name)
+        file = '{}/{}.csv'.format(self.out_dir, name)
         if not is_safe_path(self.basedir, file):
             log.error('*** Directory traversal attack: %s\n%s',
-                file, city.name)
+                file, name)
             return
 
-        f = open('{}/{}.csv'.format(self.out_dir, city.name), 'w')
+        f = open('{}/{}.csv'.format(self.out_dir, name), 'w')
+        self.written.append(file)
  
         substances = sorted(self.substances)
 
@@ -98,47 +393,362 @@ class Conversor(object):
         # And units line
         f.write(separator.join(['yyyy-mm-dd', 'hh:mm'] +
             [s[1] for s in substances]).strip() + '\n')
-        # Get all timepoints used for this city
-        timepoints = set()
-        for y in [city.data[x].keys() for x in city.substances]:
-            timepoints = timepoints.union(y)
-        timepoints = sorted(timepoints)
-        # Write data
-        for t in timepoints:
-            vs = [city.data.get(s[0], dict()).get(t, '') for s in substances]
-            # Take care of daily/montly generated data (no hh::mm)
-            ts = t.split(' ') if len(t.split(' ')) == 2 else [t, '']
-            f.write(separator.join(ts + vs) + '\n')
-        f.close()
+        return f
+
+    def _binary_path(self, name):
+        return '{}/{}{}'.format(self.out_dir, name, binary.EXTENSION)
+
+    def _open_binary(self, name):
+        # Collects the rows written to the CSV, if binary output is wanted
+        if not self.binary:
+            return
+        substances = sorted(self.substances)
+        self.written.append(self._binary_path(name))
+        return binary.Writer(path = self._binary_path(name), city = name,
+            substances = [s[0] for s in substances],
+            units = [s[1] for s in substances])
+
+    def _write_row(self, f, t, vs, out = None):
+        # Take care of daily/montly generated data (no hh::mm)
+        ts = t.split(' ') if len(t.split(' ')) == 2 else [t, '']
+        f.write(separator.join(ts + vs) + '\n')
+        if out is not None:
+            out.add(t, vs)
     
+    def convert_csv_stream(self, filenames):
+        # Values are never kept in memory: a first pass finds out which
+        # columns hold data, then every city is written merging its files
+        # row by row. This relies on the files being ordered by time.
+        columns = dict()
+        seen = set()
+        for filename in filenames:
+            with archive.open_text(filename) as buf:
+                file_separator, city_names, substances, units = \
+                    read_header(buf)
+                used = set()
+                for l in read_rows(buf, file_separator):
+                    used.update(i for i, v in enumerate(l[1:]) if v)
+            for city in city_names:
+                if city not in self.cities:
+                    self.cities[city] = CityData(name = city)
+            columns[filename] = []
+            for i, (city, substance, us) in enumerate(
+                    zip(city_names, substances, units)):
+                if i not in used:
+                    continue
+                columns[filename].append((i + 1, city, substance))
+                # The unit of the first file with data for a substance wins
+                if (city, substance) not in seen:
+                    seen.add((city, substance))
+                    self.cities[city].substances.append(substance)
+                    self.cities[city].units.append(us)
+                    self.substances.add((substance, us))
+
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        with open('{}/_cities.csv'.format(self.out_dir), 'w') as f:
+            for c in sorted(self.cities.values(), key = lambda c: c.name):
+                with metrics.timer('write_seconds'):
+                    rows = self._merge_city(c, columns)
+                metrics.inc('rows_written_total', rows)
+                f.write(c.name + '\n')
+        self.written.append('{}/_cities.csv'.format(self.out_dir))
+
+    def _merge_city(self, city, columns):
+        # Returns the number of rows written
+        f = self._open_csv(city.name)
+        if f is None:
+            return 0
+        substances = [s[0] for s in sorted(self.substances)]
+        out = self._open_binary(city.name)
+        streams = [self._stream(filename, [(i, s) for i, c, s in cols
+                if c == city.name])
+            for filename, cols in columns.items()
+            if any(c == city.name for i, c, s in cols)]
+        # Rows of all files with the same time make up one joint row,
+        # later files overwrite earlier ones like in convert_csv_part
+        row, last, rows = dict(), None, 0
+        for t, values in heapq.merge(*streams, key = lambda r: r[0]):
+            if t != last and last is not None:
+                self._write_row(f, last,
+                    [row.get(s, '') for s in substances], out)
+                rows += 1
+                row = dict()
+            row.update(values)
+            last = t
+        if last is not None:
+            self._write_row(f, last, [row.get(s, '') for s in substances], out)
+            rows += 1
+        f.close()
+        if out is not None:
+            out.close()
+        return rows
+
+    def _stream(self, filename, cols):
+        # (time, [(substance, value)]) of every row with data for cols
+        last, rows = None, 0
+        with archive.open_text(filename) as buf:
+            file_separator = read_header(buf)[0]
+            for l in read_rows(buf, file_separator):
+                rows += 1
+                if last is not None and l[0] < last:
+                    raise ValueError('{} is not ordered by time'.format(
+                        filename))
+                last = l[0]
+                values = [(s, l[i].replace(',', '.')) for i, s in cols
+                    if i < len(l) and l[i]]
+                if values:
+                    yield l[0], values
+        metrics.inc('rows_parsed_total', rows)
+
     def convert_csv(self, str_data = None, filenames = None):
+        if filenames is not None and self.incremental:
+            return self.convert_csv_incremental(filenames)
+        if filenames is not None and self.streaming:
+            return self.convert_csv_stream(filenames)
         if str_data is not None:
             data = data.split('Datum Zeit')
             for part in str_data:
                 self.convert_csv_part(StringIO(part))
+        if filenames is not None and self.processes > 1:
+            return self.convert_csv_parallel(filenames)
         if filenames is not None:
             for filename in filenames:
-                self.convert_csv_part(open(filename, 'r'))
+                with archive.open_text(filename) as buf:
+                    self.convert_csv_part(buf)
             
         if not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
         with open('{}/_cities.csv'.format(self.out_dir), 'w') as f:
-            for c in sorted(self.cities.values()):
+            for c in sorted(self.cities.values(), key = lambda c: c.name):
                 self.write_csv(c)
                 f.write(c.name + '\n')
+        self.written.append('{}/_cities.csv'.format(self.out_dir))
+
+    def convert_csv_parallel(self, filenames):
+        # Files are parsed on their own in a pool of processes, the partial
+        # results are merged in file order so that the outcome is the same
+        # as reading them one after another
+        with ProcessPoolExecutor(self.processes) as pool:
+            for part in metrics.pool_map(pool, parse_file, filenames,
+                    [self.columnar] * len(filenames)):
+                self.merge(part)
+
+            if not os.path.exists(self.out_dir):
+                os.makedirs(self.out_dir)
+            cities = sorted(self.cities.values(), key = lambda c: c.name)
+            # Every process writes whole cities, it only needs the columns
+            writer = Conversor(substances = self.substances,
+                basedir = self.basedir, out_dir = self.out_dir,
+                columnar = self.columnar, binary = self.binary)
+            for written in metrics.pool_map(pool, write_city,
+                    [writer] * len(cities), cities):
+                self.written.extend(written)
+        with open('{}/_cities.csv'.format(self.out_dir), 'w') as f:
+            for c in cities:
+                f.write(c.name + '\n')
+        self.written.append('{}/_cities.csv'.format(self.out_dir))
+
+    def convert_csv_incremental(self, filenames):
+        # The state file of out_dir tells which raw files were converted
+        # last time and which cities they hold. Only files that changed are
+        # parsed, only their cities are written again.
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        state = sources.Sources.load(
+            os.path.join(self.out_dir, sources.FILENAME))
+        names = [os.path.basename(f) for f in filenames]
+        changed = [f for f in filenames if not state.is_unchanged(f)]
+        removed = [name for name in state.files if name not in names]
+        if not changed and not removed and \
+                os.path.exists('{}/_cities.csv'.format(self.out_dir)):
+            log.info('%s is up to date', self.out_dir)
+            return
+
+        # Cities of a changed file before and after the change
+        affected = state.cities_of(
+            [os.path.basename(f) for f in changed if
+                os.path.basename(f) in state.files] + removed)
+        for name in removed:
+            del state.files[name]
+        parts = dict(zip(changed, self._parse_files(changed)))
+        for filename, part in parts.items():
+            state.record(filename, part)
+            affected.update(part.cities)
+
+        cities = state.cities_of(names)
+        substances = state.substances_of(names)
+        # Other columns change the layout of every city file
+        if substances != set(state.substances):
+            affected = cities
+        affected = set(c for c in cities if c in affected or
+            not os.path.exists('{}/{}.csv'.format(self.out_dir, c)) or
+            self.binary and not os.path.exists(self._binary_path(c)))
+        log.info('Converting %d of %d files for %d of %d cities',
+            len(changed), len(filenames), len(affected), len(cities))
+
+        # Every file holding one of the cities is needed to write it
+        needed = [f for f in filenames if f not in parts and
+            affected & state.cities_of([os.path.basename(f)])]
+        parts.update(zip(needed, self._parse_files(needed)))
+        for filename in filenames:
+            if filename in parts:
+                self.merge(parts[filename])
+        self.substances = substances
+        for name in sorted(affected):
+            self.write_csv(self.cities[name])
+
+        # Cities no longer in any raw file leave no files behind
+        removed = sorted(set(state.cities) - set(cities))
+        for name in removed:
+            self._remove_city(name)
+        if removed:
+            self.written.extend(aggregates.forget(self.out_dir, removed,
+                separator))
+
+        if sorted(cities) != sorted(state.cities) or \
+                not os.path.exists('{}/_cities.csv'.format(self.out_dir)):
+            with open('{}/_cities.csv'.format(self.out_dir), 'w') as f:
+                for name in sorted(cities):
+                    f.write(name + '\n')
+            self.written.append('{}/_cities.csv'.format(self.out_dir))
+        state.substances = list(substances)
+        state.cities = list(cities)
+        state.save()
+
+    def _remove_city(self, name):
+        # Removed files count as written, so that their removal is published
+        for path in ('{}/{}.csv'.format(self.out_dir, name),
+                self._binary_path(name),
+                os.path.join(self.out_dir, name + aggregates.EXTENSION)):
+            if os.path.exists(path):
+                log.info('Removing %s', path)
+                os.remove(path)
+                self.written.append(path)
+
+    def _parse_files(self, filenames):
+        if self.processes <= 1 or len(filenames) <= 1:
+            return [parse_file(f, self.columnar) for f in filenames]
+        with ProcessPoolExecutor(self.processes) as pool:
+            return list(metrics.pool_map(pool, parse_file, filenames,
+                [self.columnar] * len(filenames)))
+
+    def merge(self, part):
+        # Add the cities parsed by another Conversor
+        for name, city in part.cities.items():
+            if name not in self.cities:
+                self.cities[name] = city.__class__(name = name)
+            own = self.cities[name]
+            if self.columnar:
+                own.midnight_24 = own.midnight_24 or city.midnight_24
+            for substance, us in zip(city.substances, city.units):
+                if substance not in own.substances:
+                    own.substances.append(substance)
+                    own.units.append(us)
+                    self.substances.add((substance, us))
+                    if self.columnar:
+                        own.series[substance] = Series(unit = us)
+                    else:
+                        own.data[substance] = dict()
+                if self.columnar:
+                    series = own.series[substance]
+                    other = city.series[substance]
+                    series.times.extend(other.times)
+                    series.timed.extend(other.timed)
+                    series.values.extend(other.values)
+                    series.formats.extend(other.formats)
+                else:
+                    own.data[substance].update(city.data[substance])
+
+    def write_aggregates(self):
+        self.written.extend(write_aggregates(self.out_dir, self.written))
+
+def write_aggregates(out_dir, written):
+    # Aggregates of the cities written now and of those without any yet,
+    # returns the paths written
+    if not os.path.exists(out_dir):
+        return []
+    written = set(os.path.basename(p) for p in written)
+    cities = [c for c in aggregates.cities_of(out_dir)
+        if '{}.csv'.format(c) in written or not os.path.exists(
+            os.path.join(out_dir, c + aggregates.EXTENSION))]
+    if not cities:
+        return []
+    with metrics.timer('aggregate_seconds'):
+        return aggregates.update(out_dir, cities, separator)
+
+def parse_file(filename, columnar = False):
+    # Run in a worker process, returns a Conversor holding just this file
+    conversor = Conversor(columnar = columnar)
+    with archive.open_text(filename) as buf:
+        conversor.convert_csv_part(buf)
+    return conversor
+
+def write_city(conversor, city):
+    # Returns the paths written in the worker process
+    conversor.write_csv(city)
+    return conversor.written
+
+def convert_dir(data_dir, out_dir, basedir, **options):
+    # Returns the paths written
+    return main(data_dir = data_dir, out_dir = out_dir, basedir = basedir,
+        **options)
+
+def convert_tree(data_dir, out_dir = 'data', basedir = os.getcwd(),
+        processes = 1, **options):
+    # Convert every YYYY/MM directory below data_dir into the same
+    # directory below out_dir, one month per process
+    dirs = sorted(os.path.join(year, month)
+        for year in os.listdir(data_dir)
+        if year.isdigit() and os.path.isdir(os.path.join(data_dir, year))
+        for month in os.listdir(os.path.join(data_dir, year))
+        if os.path.isdir(os.path.join(data_dir, year, month)))
+    return convert_dirs([(os.path.join(data_dir, d), os.path.join(out_dir, d))
+        for d in dirs], basedir, processes, **options)
+
+def convert_dirs(dirs, basedir = os.getcwd(), processes = 1,
+        aggregates = False, **options):
+    # dirs is a list of (raw directory, output directory), months in order
+    if processes <= 1:
+        return [convert_dir(d, o, basedir, aggregates = aggregates,
+                **options)
+            for d, o in dirs]
+    with ProcessPoolExecutor(processes) as pool:
+        jobs = [pool.submit(metrics.collect, convert_dir, d, o, basedir,
+                **options)
+            for d, o in dirs]
+        results = []
+        for job in jobs:
+            result, snapshot = job.result()
+            metrics.registry.merge(snapshot)
+            results.append(result)
+    # Aggregates continue from the month before, one month after another
+    if aggregates:
+        for (d, o), result in zip(dirs, results):
+            result.extend(write_aggregates(o, result))
+    return results
 
 def main(filename = None, data_dir = None, out_dir = 'data',
-        basedir = os.getcwd()):
+        basedir = os.getcwd(), streaming = False, columnar = False,
+        processes = 1, incremental = False, binary = False,
+        aggregates = False):
     if filename is not None:
         return Conversor(
-            out_dir = out_dir, basedir = basedir).convert_csv(
-                str_data = open(filename, 'r').read())
+            out_dir = out_dir, basedir = basedir,
+            columnar = columnar, binary = binary).convert_csv(
+                str_data = archive.read(filename))
     if data_dir is not None:
-        files = [os.path.join(data_dir, f) for f in os.listdir(data_dir)
-            if os.path.isfile(os.path.join(data_dir, f))]
-        return Conversor(
-            out_dir = out_dir, basedir = basedir).convert_csv(
-                filenames = files)
+        # Plain and archived raw files alike
+        files = [os.path.join(data_dir, f) for f in archive.listdir(data_dir)]
+        conversor = Conversor(
+            out_dir = out_dir, basedir = basedir,
+            streaming = streaming, columnar = columnar,
+            processes = processes, incremental = incremental,
+            binary = binary, aggregates = aggregates)
+        conversor.convert_csv(filenames = files)
+        if aggregates:
+            conversor.write_aggregates()
+        return conversor.written
 
 if __name__ == '__main__':
     from logging.handlers import RotatingFileHandler
@@ -158,6 +768,34 @@ Call it with --file FILE, where FILE has been manually downloaded from Umwelt
 Sachsen, it generates developer friendlier CSV files in the data subdirectory.
 
 File separator can be specified with --separator SEPARATOR, it defaults to ','.
+
+With --stream the files of --data-dir are merged row by row, memory use
+then only depends on the number of files. The files need to be ordered by
+time, as the ones written by the importer are.
+
+With --columnar values are parsed into float64 numpy arrays a whole file at
+a time, along with the number format of every file and column, so that the
+output is the same as without it. --columnar and --binary need numpy.
+
+--jobs N parses and writes with N processes. With --tree, --data-dir is a
+directory of YYYY/MM subdirectories as written by the importer, every month
+is converted into the same subdirectory of --out-dir, N months at a time.
+
+With --incremental only the raw files that changed since the last run (by
+modification time, size and hash) are parsed again and only the cities they
+hold are written again, together with the files those cities need. The files
+of cities no longer in any raw file are removed. The state is kept in
+.sources.json of the output directory. --stream has no effect then.
+
+Raw files kept in the archive of the importer (--archive) are read from
+their compressed objects directly, see archive.py.
+
+With --binary every city is also written as CITY.lqd, a fixed layout of
+int64 timestamps and float32 values that can be memory mapped, see binary.py.
+
+With --aggregates daily and monthly means, rolling 8 and 24 hour means and
+exceedances of the EU limits are kept in CITY.agg next to every city, only
+computed from the rows added since the last run, see aggregates.py.
 """)
  
     parser.add_option(
@@ -184,6 +822,55 @@ File separator can be specified with --separator SEPARATOR, it defaults to ','.
         default = separator,
         help = u"Separator for the csv",
     )
+    parser.add_option(
+        "--stream",
+        action = 'store_true',
+        dest = "streaming",
+        default = False,
+        help = u"Merge files row by row with bounded memory",
+    )
+    parser.add_option(
+        "--columnar",
+        action = 'store_true',
+        dest = "columnar",
+        default = False,
+        help = u"Parse values into numpy arrays",
+    )
+    parser.add_option(
+        "-j", "--jobs",
+        dest = "processes",
+        type = "int",
+        default = 1,
+        help = u"Number of processes converting in parallel",
+    )
+    parser.add_option(
+        "-t", "--tree",
+        action = 'store_true',
+        dest = "tree",
+        default = False,
+        help = u"Convert all YYYY/MM subdirectories of --data-dir",
+    )
+    parser.add_option(
+        "-i", "--incremental",
+        action = 'store_true',
+        dest = "incremental",
+        default = False,
+        help = u"Only convert again what changed since the last run",
+    )
+    parser.add_option(
+        "--binary",
+        action = 'store_true',
+        dest = "binary",
+        default = False,
+        help = u"Also write memory mappable binary files",
+    )
+    parser.add_option(
+        "--aggregates",
+        action = 'store_true',
+        dest = "aggregates",
+        default = False,
+        help = u"Keep daily and monthly aggregates of every city",
+    )
   
     (options, arguments) = parser.parse_args()
     separator = options.separator
@@ -192,7 +879,16 @@ File separator can be specified with --separator SEPARATOR, it defaults to ','.
         parser.error(u'Call with either --file FILE.csv or --data-dir DIR')
         
     if options.filename:
-        main(filename = options.filename, out_dir = options.out_dir)
+        main(filename = options.filename, out_dir = options.out_dir,
+            columnar = options.columnar, binary = options.binary)
+    elif options.tree:
+        convert_tree(options.data_dir, out_dir = options.out_dir,
+            processes = options.processes, streaming = options.streaming,
+            columnar = options.columnar, incremental = options.incremental,
+            binary = options.binary, aggregates = options.aggregates)
     else:
-        main(data_dir = options.data_dir, out_dir = options.out_dir)
+        main(data_dir = options.data_dir, out_dir = options.out_dir,
+            streaming = options.streaming, columnar = options.columnar,
+            processes = options.processes, incremental = options.incremental,
+            binary = options.binary, aggregates = options.aggregates)
         
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import attr
+
+import re
+from html import unescape
+import logging
+log = logging.getLogger('uws')
+
+from bs4 import BeautifulSoup
+
+# The postback pages are mostly ViewState, only the hidden inputs and the
+# select lists are of interest. They are picked out with regular
+# expressions instead of building a whole DOM.
+INPUT = re.compile(r'<input\b([^>]*)>', re.I)
+SELECT = re.compile(r'<select\b([^>]*)>(.*?)</select\s*>', re.I | re.S)
+OPTION = re.compile(r'<option\b([^>]*)>([^<]*)', re.I)
+ATTRIBUTE = re.compile(
+    r'''([^\s=/>]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+
+def attributes(tag):
+    return dict((m.group(1).lower(), unescape(
+            m.group(2) or m.group(3) or m.group(4) or ''))
+        for m in ATTRIBUTE.finditer(tag))
+
+@attr.s
+class FormPage(object):
+    text = attr.ib()
+    # Hidden inputs by id and options of the select lists by id
+    fields = attr.ib(default = attr.Factory(dict))
+    selects = attr.ib(default = attr.Factory(dict))
+
+    _soup = attr.ib(default = None)
+
+    @classmethod
+    def parse(cls, text):
+        page = cls(text = text)
+        for m in INPUT.finditer(text):
+            attrs = attributes(m.group(1))
+            if attrs.get('type', '').lower() == 'hidden' and 'id' in attrs:
+                page.fields[attrs['id']] = attrs.get('value', '')
+        for m in SELECT.finditer(text):
+            id = attributes(m.group(1)).get('id')
+            if id is None:
+                continue
+            page.selects[id] = [
+                (attributes(o.group(1)).get('value'), unescape(o.group(2)))
+                for o in OPTION.finditer(m.group(2))]
+        return page
+
+    def field(self, id):
+        # Fields may be missing, only a page without any hidden input at
+        # all is a reason to distrust the expressions
+        if self.fields:
+            return self.fields.get(id)
+        el = self.soup().find(id = id)
+        return el['value'] if el is not None else None
+
+    def options(self, id):
+        # (value, text) of every option of the select with the given id
+        if id not in self.selects:
+            log.debug('Select %s not found, parsing the whole page', id)
+            self.selects[id] = [(i['value'], i.string)
+                for i in self.soup().find(id = id).find_all('option')]
+        return self.selects[id]
+
+    def soup(self):
+        # Full parse, only for pages the expressions above can not handle
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.text, 'html.parser')
+        return self._soup
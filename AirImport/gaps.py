@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, datetime, json, calendar, zlib
+import logging
+log = logging.getLogger('uws')
+
+try:
+    from .manifest import Manifest
+    from .reader import seconds
+    from . import archive
+except:
+    from manifest import Manifest
+    from reader import seconds
+    import archive
+
+# Gaps of raw files (YYYY/MM/station,substance.csv)
+ERROR = 'err'
+HTML = 'html'
+TRUNCATED = 'truncated'
+ABSENT = 'absent'
+MISSING = 'missing'
+EMPTY = 'empty'
+# Gaps of joint files (YYYY/MM/city.csv)
+UNCONVERTED = 'unconverted'
+STALE = 'stale'
+BROKEN = 'broken'
+
+# Gaps repaired by downloading again and by converting again. Empty values
+# are what the site returned as 'n. def.', downloading them again rarely
+# helps, so they are only reported by default.
+REFETCH = (ERROR, HTML, TRUNCATED, ABSENT, MISSING)
+CONVERT = (UNCONVERTED, STALE, BROKEN)
+
+def labels(period, step, midnight_24 = True):
+    # Times of all rows of a month as written in raw files, in order. The
+    # end of a day is written as 24:00 of it, or as 00:00 of the next day
+    # with midnight_24 False.
+    year, month = int(period[:4]), int(period[5:])
+    if step == 'month':
+        return ['{:02d}-{:04d}'.format(month, year)]
+    days = ['{:02d}.{:02d}.{:02d}'.format(day, month, year % 100)
+        for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+    if step == 'day':
+        return days
+    hours = range(1, 25) if midnight_24 else range(0, 24)
+    return ['{} {:02d}:00'.format(day, hour)
+        for day in days for hour in hours]
+
+def step_of(label):
+    if len(label) < 8:
+        return 'month'
+    return 'day' if len(label) == 8 else 'hour'
+
+def label_seconds(label):
+    # Timestamp of a raw time as used by the joint files
+    if step_of(label) == 'month':
+        return seconds('{}-{}-01'.format(label[3:], label[:2]), '')
+    return seconds('20{}-{}-{}'.format(label[6:8], label[3:5], label[:2]),
+        label[9:])
+
+def ranges(items):
+    # Runs of consecutive indexes as (first, last, count)
+    runs = []
+    for i in items:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1] = (runs[-1][0], i, runs[-1][2] + 1)
+        else:
+            runs.append((i, i, 1))
+    return runs
+
+@attr.s
+class Gap(object):
+    kind = attr.ib()
+    # YYYY/MM
+    period = attr.ib()
+    # Station of raw gaps, city of joint gaps
+    station = attr.ib()
+    substance = attr.ib(default = None)
+    # First and last time missing, as written in raw files
+    start = attr.ib(default = None)
+    end = attr.ib(default = None)
+    # Number of rows missing
+    count = attr.ib(default = None)
+
+    def day(self):
+        # First day to download again, it is replaced up to the month end
+        if self.start is None or step_of(self.start) == 'month':
+            return 1
+        return int(self.start[:2])
+
+@attr.s
+class Report(object):
+    # Gaps found by scan(), saved as compact JSON
+    path = attr.ib(default = None)
+    gaps = attr.ib(default = attr.Factory(list))
+    generated = attr.ib(default = None)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(path = path, generated = data['generated'],
+            gaps = [Gap(**g) for g in data['gaps']])
+
+    def save(self, path = None):
+        self.path = path or self.path
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(dict(generated = self.generated, gaps = [
+                    attr.asdict(g, filter = lambda a, v: v is not None)
+                    for g in self.gaps]),
+                f, sort_keys = True)
+        os.replace(tmp, self.path)
+
+    def queue(self, kinds = REFETCH):
+        # Work queue of the importer: {(station, substance): {(year, month):
+        # first day}}, only the end of a month from that day on is downloaded
+        work = {}
+        for gap in self.gaps:
+            if gap.kind not in kinds or gap.substance is None:
+                continue
+            period = (int(gap.period[:4]), int(gap.period[5:]))
+            months = work.setdefault((gap.station, gap.substance), {})
+            months[period] = min(months.get(period, 31), gap.day())
+        return work
+
+    def months(self, kinds = CONVERT):
+        # YYYY/MM directories to convert again
+        return sorted(set(g.period for g in self.gaps if g.kind in kinds))
+
+    def summary(self):
+        counts = {}
+        for gap in self.gaps:
+            counts[gap.kind] = counts.get(gap.kind, 0) + 1
+        return counts
+
+def month_dirs(data_dir):
+    return sorted('{}/{}'.format(year, month)
+        for year in os.listdir(data_dir)
+        if year.isdigit() and os.path.isdir(os.path.join(data_dir, year))
+        for month in os.listdir(os.path.join(data_dir, year))
+        if os.path.isdir(os.path.join(data_dir, year, month)))
+
+def raw_files(month_dir):
+    # {(station, substance): set of extensions} of a raw month
+    files = {}
+    for name in archive.listdir(month_dir):
+        base, _, ext = name.rpartition('.')
+        if ext not in ('csv', ERROR, HTML) or ',' not in base:
+            continue
+        station, substance = base.rsplit(',', 1)
+        files.setdefault((station, substance), set()).add(ext)
+    return files
+
+def month_end(period):
+    year, month = int(period[:4]), int(period[5:])
+    return datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+def check_csv(path, period, station, substance, fetched = None):
+    # Gaps of a downloaded raw file and the time of its last row. Missing
+    # rows are only looked for up to the last row of months that had not
+    # ended when they were downloaded.
+    gaps = []
+    def gap(kind, start = None, end = None, count = None):
+        gaps.append(Gap(kind = kind, period = period, station = station,
+            substance = substance, start = start, end = end, count = count))
+    try:
+        lines = archive.read(path).splitlines()
+    except (OSError, EOFError, ValueError, zlib.error):
+        gap(TRUNCATED)
+        return gaps, None
+    if len(lines) < 2:
+        gap(TRUNCATED)
+        return gaps, None
+    separator = ';' if len(lines[0].split(';')) > 1 else ','
+    fields = len(lines[0].split(separator))
+
+    present, empty, last = {}, [], None
+    expected = None
+    # The site writes 24:00, files using 00:00 instead are taken as they are
+    midnight_24 = not any(' 00:00' in line for line in lines[2:])
+    for line in lines[2:]:
+        if not line.strip():
+            continue
+        row = [txt.strip() for txt in line.split(separator)]
+        if expected is None:
+            expected = labels(period, step_of(row[0]), midnight_24)
+            index = dict((l, i) for i, l in enumerate(expected))
+        if len(row) != fields or row[0] not in index:
+            # Cut off while being written or downloaded
+            gap(TRUNCATED, start = last)
+            break
+        present[index[row[0]]] = row
+        if not any(v and v != 'n. def.' for v in row[1:]):
+            empty.append(index[row[0]])
+        last = row[0]
+    if expected is None:
+        # No rows at all
+        if fetched is not None and fetched >= month_end(period):
+            gap(MISSING)
+        return gaps, None
+
+    if fetched is not None and fetched >= month_end(period) and \
+            not any(g.kind == TRUNCATED for g in gaps):
+        until = len(expected)
+    else:
+        until = max(present) + 1 if present else 0
+    for first, final, count in ranges(
+            [i for i in range(until) if i not in present]):
+        gap(MISSING, expected[first], expected[final], count)
+    for first, final, count in ranges(empty):
+        gap(EMPTY, expected[first], expected[final], count)
+    return gaps, last
+
+def check_joint(path, last = None, separator = ','):
+    # Whether a joint file is complete: a header, a units row and rows of
+    # the same width, reaching up to last
+    try:
+        with open(path, 'rb') as f:
+            lines = [l for l in f.read().decode('utf-8').splitlines()
+                if l.strip()]
+    except (OSError, UnicodeDecodeError):
+        return False
+    if len(lines) < 2:
+        return False
+    fields = len(lines[0].split(separator))
+    if fields < 2 or not all(len(l.split(separator)) == fields
+            for l in lines[1:]):
+        return False
+    if last is None:
+        return True
+    if len(lines) < 3:
+        return False
+    date, hour = lines[-1].split(separator)[:2]
+    return seconds(date, hour) >= last
+
+def scan(raw_dir, joint_dir = None, manifest = None, separator = ','):
+    # Gaps of all months of raw_dir, and of their joint files below
+    # joint_dir if given, written with separator
+    if manifest is None and \
+            os.path.exists(os.path.join(raw_dir, 'manifest.json')):
+        manifest = Manifest.load(os.path.join(raw_dir, 'manifest.json'))
+    months = month_dirs(raw_dir)
+    files = dict((m, raw_files(os.path.join(raw_dir, m))) for m in months)
+    # Months with a file of every station and substance
+    seen = {}
+    for month in months:
+        for key, exts in files[month].items():
+            if 'csv' in exts:
+                seen.setdefault(key, []).append(month)
+
+    gaps = []
+    for month in months:
+        log.debug('Scanning %s', month)
+        # Time of the last row of every station
+        lasts = {}
+        for (station, substance), exts in sorted(files[month].items()):
+            for kind in (ERROR, HTML):
+                if kind in exts:
+                    gaps.append(Gap(kind = kind, period = month,
+                        station = station, substance = substance))
+            if 'csv' not in exts:
+                continue
+            path = os.path.join(raw_dir, month,
+                '{},{}.csv'.format(station, substance))
+            fetched = None
+            entry = manifest.get(station, substance, month.split('/')) \
+                if manifest is not None else None
+            if entry is not None:
+                fetched = datetime.datetime.strptime(
+                    entry['fetched'][:19], '%Y-%m-%dT%H:%M:%S')
+            else:
+                fetched = datetime.datetime.fromtimestamp(
+                    archive.getmtime(path))
+            found, last = check_csv(path, month, station, substance, fetched)
+            gaps.extend(found)
+            if last is not None:
+                lasts[station] = max(lasts.get(station, 0),
+                    label_seconds(last))
+        # Series with months before and after this one, but none here
+        for key, present in sorted(seen.items()):
+            if month not in present and present[0] < month < present[-1] \
+                    and key not in files[month]:
+                gaps.append(Gap(kind = ABSENT, period = month,
+                    station = key[0], substance = key[1]))
+
+        if joint_dir is None:
+            continue
+        stations = {}
+        for (station, substance), exts in files[month].items():
+            if 'csv' in exts:
+                mtime = archive.getmtime(os.path.join(raw_dir, month,
+                    '{},{}.csv'.format(station, substance)))
+                stations[station] = max(stations.get(station, 0), mtime)
+        for station, mtime in sorted(stations.items()):
+            path = os.path.join(joint_dir, month, '{}.csv'.format(station))
+            if not os.path.exists(path):
+                kind = UNCONVERTED
+            elif not check_joint(path, lasts.get(station), separator):
+                kind = BROKEN
+            elif os.path.getmtime(path) < mtime:
+                kind = STALE
+            else:
+                continue
+            gaps.append(Gap(kind = kind, period = month, station = station))
+    return Report(gaps = gaps, generated = datetime.datetime.now().isoformat())
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.addHandler(StreamHandler(sys.stderr))
+    log.setLevel(logging.INFO)
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Looks for gaps in the raw files below --raw-dir (YYYY/MM subdirectories as
+written by the importer) and in the joint files below --joint-dir, written
+with --separator:
+
+* err/html: failed downloads, or the site answered with a page
+* truncated: files cut off while being written or downloaded
+* absent: no file for a month while the months around have one
+* missing: hours, days or months without a row, only up to the last row for
+  months downloaded before they ended
+* empty: rows without a value ('n. def.'), only reported
+* unconverted/stale/broken: joint files missing, older than their raw files
+  or cut off
+
+The report is written to --output and can be passed to the importer with
+--gaps FILE, which then only downloads the end of each month from the first
+day with a gap on. Months with joint gaps need to be converted again.
+""")
+
+    parser.add_option(
+        "-r", "--raw-dir",
+        dest = "raw_dir",
+        default = "raw",
+        help = u"Directory of raw YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "-j", "--joint-dir",
+        dest = "joint_dir",
+        default = None,
+        help = u"Directory of joint YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "-s", "--separator",
+        dest = "separator",
+        default = ",",
+        help = u"Separator of the joint files",
+    )
+    parser.add_option(
+        "-o", "--output",
+        dest = "output",
+        default = "gaps.json",
+        help = u"File to write the report to",
+    )
+
+    (options, arguments) = parser.parse_args()
+    report = scan(options.raw_dir, options.joint_dir,
+        separator = options.separator)
+    report.save(options.output)
+    for kind, count in sorted(report.summary().items()):
+        log.info('%s: %d', kind, count)
+    work = report.queue()
+    log.info('%d downloads for %d series, %d months to convert again',
+        sum(len(m) for m in work.values()), len(work), len(report.months()))
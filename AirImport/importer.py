@@ -2,18 +2,33 @@
 
 import attr
 
-import os, datetime
+import os, re, datetime, time
 import logging, traceback
 log = logging.getLogger('uws')
 
 from io import StringIO
 import requests
-from bs4 import BeautifulSoup
 
 try:
     from . import UmweltSachsen as uws
+    from . import metrics
+    from .manifest import Manifest, OK, ERROR, HTML
+    from .catalog import Catalog
+    from . import archive
+    from .formparser import FormPage
+    from .transport import Transport
 except:
     import UmweltSachsen as uws
+    import metrics
+    from manifest import Manifest, OK, ERROR, HTML
+    from catalog import Catalog
+    import archive
+    from formparser import FormPage
+    from transport import Transport
+
+# Hidden fields the server sends with every page, posted back as they are
+STATE_FIELDS = (uws.VALIDATION, uws.VIEWSTATE, uws.VIEWSTATEGEN,
+    '__SCROLLPOSITIONX', '__SCROLLPOSITIONY', '__EVENTARGUMENT', '__LASTFOCUS')
 
 def is_safe_path(basedir, path, follow_symlinks=True):
     # resolves symbolic links
@@ -21,6 +36,98 @@ def is_safe_path(basedir, path, follow_symlinks=True):
         return os.path.realpath(path).startswith(basedir)
     return os.path.abspath(path).startswith(basedir)
 
+def next_month(period):
+    year, month = period
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def row_period(time):
+    # Month of a data row, rows look like dd.mm.yy hh:mm or dd.mm.yy
+    # for hourly and daily data and mm-yyyy for monthly data
+    if len(time) < 8:
+        return (time[3:], time[:2])
+    return ('20' + time[6:8], time[3:5])
+
+def row_key(time):
+    # Sortable (year, month, day, hour) of the time of a data row
+    if len(time) < 8:
+        return (time[3:], time[:2], '', '')
+    return ('20' + time[6:8], time[3:5], time[:2], time[9:])
+
+def row_datetime(time):
+    year, month, day, hour = row_key(time)
+    date = datetime.datetime(int(year), int(month), int(day or 1))
+    if hour:
+        date += datetime.timedelta(hours = int(hour[:2]),
+            minutes = int(hour[3:5]))
+    return date
+
+# Options of the "last ..." select read like "letzte 24 Stunden"
+LAST_SPAN = re.compile(r'(\d+)?\s*(Stunde|Tag|Woche|Monat)', re.I)
+SPAN_UNITS = dict(stunde = 1 / 24., tag = 1, woche = 7, monat = 31)
+
+def last_span(text):
+    # Time covered by an option of the "last ..." select, None for the
+    # free period
+    m = LAST_SPAN.search(text or '')
+    if m is None:
+        return None
+    return datetime.timedelta(
+        days = int(m.group(1) or 1) * SPAN_UNITS[m.group(2).lower()])
+
+def split_by_month(data, separator = ','):
+    # Split a csv spanning several months, every part keeps the header
+    lines = data.splitlines(True)
+    parts = dict(header = lines[:2])
+    for line in lines[2:]:
+        if not line.strip():
+            continue
+        period = row_period(line.split(separator)[0].strip())
+        parts.setdefault(period, list(lines[:2])).append(line)
+    return dict((k, ''.join(v)) for k, v in parts.items())
+
+def last_time(data, separator = ','):
+    # Time of the last row of a csv, None if it has no rows
+    lines = [l for l in data.splitlines()[2:] if l.strip()]
+    if not lines:
+        return None
+    return lines[-1].split(separator)[0].strip()
+
+def merge_tail(file, data, day, separator = ','):
+    # Replace the rows of an already downloaded month from day on
+    if not archive.exists(file):
+        return data
+    old = archive.read(file).splitlines(True)[2:]
+    lines = data.splitlines(True)
+    def before(line):
+        # Daily and hourly rows of the days before day, monthly rows and
+        # lines that are no rows at all are dropped
+        time = line.split(separator)[0].strip()
+        if len(time) < 8:
+            return False
+        try:
+            row_datetime(time)
+        except ValueError:
+            return False
+        # 24:00 still belongs to its day
+        return int(row_key(time)[2]) < int(day)
+    kept = [l for l in old if l.strip() and before(l)]
+    return ''.join(lines[:2] + kept + lines[2:])
+
+def merge_recent(file, data, separator = ','):
+    # Replace the rows of an already downloaded month from the first row
+    # of data on, data holding the latest rows only
+    if not archive.exists(file):
+        return data
+    old = archive.read(file).splitlines(True)[2:]
+    lines = data.splitlines(True)
+    rows = [l for l in lines[2:] if l.strip()]
+    if not rows:
+        return ''.join(lines[:2] + old)
+    first = row_key(rows[0].split(separator)[0].strip())
+    kept = [l for l in old if l.strip() and
+        row_key(l.split(separator)[0].strip()) < first]
+    return ''.join(lines[:2] + kept + rows)
+
 @attr.s
 class Substance(object):
     id = attr.ib()
@@ -38,8 +145,12 @@ class Station(object):
 class LuftOnlineSiteConfig(object):
     stations = attr.ib(default = attr.Factory(list))
 
-    _session = attr.ib(default = attr.Factory(requests.Session))
+    # Retries, keep-alive and compression of the requests, see transport.py
+    _transport = attr.ib(default = attr.Factory(Transport))
     _post_data = attr.ib(default = attr.Factory(dict))
+    # Form fields as the server knows them for this session
+    _form_state = attr.ib(default = attr.Factory(dict))
+    _pending = attr.ib(default = None)
 
     station = attr.ib(default = None)
     substance = attr.ib(default =  None)
@@ -47,145 +158,595 @@ class LuftOnlineSiteConfig(object):
     basedir = attr.ib(default = attr.Factory(lambda: os.getcwd))
     
     out_dir = attr.ib(default = attr.Factory(lambda: '.'))
+    # Separator of the csv files written, instead of '; '
+    separator = attr.ib(default = ',')
+
+    # Number of months requested with a single download
+    max_months = attr.ib(default = 1)
+    # Optional Manifest of earlier downloads, complete months are skipped
+    manifest = attr.ib(default = None)
+    # Optional Catalog of stations and substances from earlier runs
+    catalog = attr.ib(default = None)
+    # Optional work queue of gaps.Report.queue(), only its windows are
+    # downloaded then
+    gaps = attr.ib(default = None)
+    # Keep csv files compressed in the content addressed archive of
+    # archive.py instead of as plain files
+    use_archive = attr.ib(default = False)
+    # recherche.aspx, or a stand-in for it
+    url = attr.ib(default = uws.URL)
+    # New server sessions replaying the form state before a request that
+    # failed for good is given up, see _get_string
+    replays = attr.ib(default = 3)
+
+    # Options of the "last ..." select as (value, timedelta)
+    last_options = attr.ib(default = attr.Factory(list))
+    # poll downloads this much before the newest row again, the latest
+    # values may still be corrected
+    overlap = attr.ib(default = datetime.timedelta(hours = 3))
+    # Months written to since the last poll
+    touched = attr.ib(default = attr.Factory(set))
+    # Paths whose content changed, shared by all sessions of a run
+    written = attr.ib(default = attr.Factory(set))
 
     def get_live_data(self, periods = [(2016, 9)]):
-        self.read_stations()
-        for period in periods:
+        periods = list(periods)
+        try:
+            self.load_stations()
             for station in self.stations:
-                self.load_substances(station)
-                for substance in station.substances:
-                    self.set_period(period)
-                    self.load_substance_data(substance)
-                    self.get_csv_data()
+                self.get_station_data(station, periods)
+        finally:
+            self._flush_manifest()
+
+    def _flush_manifest(self):
+        if self.manifest is not None:
+            self.manifest.flush()
+
+    def get_station_data(self, station, periods):
+        # Walk station -> substance -> periods so that only the time
+        # changes between two downloads
+        if not self._has_work(station, periods):
+            return
+        self.load_substances(station)
+        for substance in station.substances:
+            for start, end, day in self.plan(substance, periods):
+                self.set_period(start, end, day)
+                self.load_substance_data(substance)
+                self.get_csv_data()
+
+    def plan(self, substance, periods):
+        # Downloads needed as (first month, last month, first day)
+        if self.gaps is not None:
+            months = self.gaps.get((substance.station.name, substance.name),
+                {})
+            return [(period, period, day)
+                for period, day in sorted(months.items()) if period in periods]
+        if self.manifest is None:
+            return [(w[0], w[-1], 1) for w in self.windows(periods)]
+        station = substance.station.name
+        full, tails = [], []
+        for period in periods:
+            if self.manifest.is_complete(station, substance.name, period):
+                continue
+            # Months downloaded before they ended only need the new days
+            day = self.manifest.tail_day(station, substance.name, period)
+            if day is None:
+                full.append(period)
+            else:
+                tails.append((period, period, day))
+        return [(w[0], w[-1], 1) for w in self.windows(full)] + tails
+
+    def _has_work(self, station, periods):
+        # Substances known beforehand (from the catalog) are planned before
+        # selecting the station, which is skipped if nothing is missing
+        if not station.substances or \
+                any(self.plan(s, periods) for s in station.substances):
+            return True
+        log.info('Nothing to download for %s', station.name)
+        return False
+
+    def windows(self, periods):
+        # Group consecutive months into downloads of up to max_months
+        windows = []
+        for period in periods:
+            if windows and len(windows[-1]) < self.max_months and \
+                    next_month(windows[-1][-1]) == tuple(period):
+                windows[-1].append(period)
+            else:
+                windows.append([period])
+        return windows
+
+    def load_stations(self):
+        # Stations of a fresh catalog save reading them, the session is
+        # then started right before the first station is selected
+        if self.catalog is None or not self.catalog.is_fresh():
+            return self.read_stations()
+        log.info('Read stations from %s', self.catalog.path)
+        self.stations.clear()
+        for s in self.catalog.stations:
+            station = Station(name = s['name'], id = s['id'])
+            station.substances.extend(self._catalog_substances(station,
+                s['substances']))
+            self.stations.append(station)
+
+    def _catalog_substances(self, station, substances):
+        return [Substance(station = station, name = c['name'], id = c['id'],
+                accuracy = c['accuracy'])
+            for c in substances]
 
     def read_stations(self):
         # Make a first page load, it contains the stations
         log.info('Read stations')
-        soup = self._get_string()
+        self._form_state.clear()
+        self._set_stations(self._get_string())
+
+    def _start_session(self):
+        # First page load of a session whose stations came from the catalog
+        log.info('Start session')
+        self._form_state.clear()
+        page = self._get_string()
+        self._set_last_options(page)
+        if self.catalog is not None:
+            self.catalog.check_stations(page.options(uws.STATIONS_ID))
+
+    def _set_last_options(self, page):
+        if uws.TIME_ID in page.selects:
+            self.last_options = [(value, last_span(name))
+                for value, name in page.options(uws.TIME_ID)
+                if last_span(name) is not None]
+
+    def _set_stations(self, page):
         # Cleanup
         for i in self.stations:
             i.substances.clear()
         self.stations.clear()
         # Do add stations
-        stations = soup.find(id = uws.STATIONS_ID)
-        for i in stations.find_all('option'):
-            self.stations.append(Station(name = i.string, id = i['value']))
+        for value, name in page.options(uws.STATIONS_ID):
+            self.stations.append(Station(name = name, id = value))
+        self._set_last_options(page)
+        if self.catalog is not None:
+            self.catalog.set_stations([(s.id, s.name) for s in self.stations])
         
     def load_substances(self, station):
+        if uws.VIEWSTATE not in self._post_data:
+            self._start_session()
+        if self._select_station(station) or not station.substances:
+            self._update_substances(station, self._get_string())
+
+    def _update_substances(self, station, page):
+        # Substances of a fresh catalog are kept with their accuracy, but
+        # the catalog takes over whatever the page lists differently
+        substances = self.catalog.substances(station.id) \
+            if self._catalog_is_fresh() else None
+        if substances is None:
+            return self._set_substances(station, page)
+        self.station = station.name
+        self.catalog.set_substances(station.id,
+            page.options(uws.SUBSTANCES_ID))
+        station.substances[:] = self._catalog_substances(station,
+            self.catalog.substances(station.id))
+
+    def _catalog_is_fresh(self):
+        return self.catalog is not None and self.catalog.is_fresh()
+
+    def _select_station(self, station):
         # Set up all stations
         log.info("Processing station %s", station.name)
-        self._post_data[uws.TARGET] = uws.STATIONS_KEY
         self._post_data[uws.STATIONS_KEY] = station.id
-        soup = self._get_string()
+        return self._postback(uws.STATIONS_KEY, station.id)
 
+    def _set_substances(self, station, page):
         self.station = station.name
 
         # Cleanup
         station.substances.clear()
         # Get substances
         log.debug('Selected station, getting substances')
-        substances = soup.find(id=uws.SUBSTANCES_ID)
-        for i in substances.find_all('option'):
+        for value, name in page.options(uws.SUBSTANCES_ID):
             station.substances.append(
-                Substance(station = station, name = i.string, id = i['value']))
+                Substance(station = station, name = name, id = value))
+        if self.catalog is not None:
+            self.catalog.set_substances(station.id,
+                [(s.id, s.name) for s in station.substances])
 
-    def set_period(self, period = (2016, 9)):
+    def set_period(self, period = (2016, 9), end_period = None, day = 1):
+        # Select the months from period to end_period, both included,
+        # starting at the given day of the first month
         def s(n):
             return '0' * (2 - len(str(n))) + str(n)
+        if end_period is None:
+            end_period = period
+        self.last, self.recent = 0, False
+        self.day = s(day)
         year, month = period
         date = datetime.datetime(year = year, month = month, day = 1)
         month_delta = datetime.timedelta(days = 31)
-        end_date = date + month_delta
+        end_date = datetime.datetime(
+            year = end_period[0], month = end_period[1], day = 1) + month_delta
         self.year, self.month = s(date.year), s(date.month)
         self.end_year, self.end_month = s(end_date.year), s(end_date.month)
+        self.periods = []
+        while tuple(period) <= tuple(end_period):
+            self.periods.append((s(period[0]), s(period[1])))
+            period = next_month(period)
+
+    def set_recent(self, last, since, now):
+        # Select the "last ..." option last, its rows go to the months from
+        # since to now
+        self.set_period((since.year, since.month), (now.year, now.month))
+        self.last, self.recent = last, True
+
+    def poll(self, now = None):
+        # Download only what is new for every substance, keeping the session
+        # and form state between calls. Returns the months written to.
+        now = now or datetime.datetime.now()
+        self.touched = set()
+        self.written.clear()
+        try:
+            if not self.stations:
+                self.load_stations()
+            for station in self.stations:
+                self.load_substances(station)
+                for substance in station.substances:
+                    since = self.last_row(substance, now)
+                    last = self.shortest_last(now - since + self.overlap) \
+                        if since is not None else None
+                    if last is None:
+                        # Nothing recent yet, download the month as usual
+                        for start, end, day in self.plan(
+                                substance, [(now.year, now.month)]):
+                            self.set_period(start, end, day)
+                            self.load_substance_data(substance)
+                            self.get_csv_data()
+                        continue
+                    self.set_recent(last, since - self.overlap, now)
+                    self.load_substance_data(substance)
+                    self.get_csv_data()
+        finally:
+            self._flush_manifest()
+        return self.touched
+
+    def last_row(self, substance, now):
+        # Time of the newest row downloaded for substance this month or the
+        # month before
+        previous = (now.year - (now.month == 1), (now.month - 2) % 12 + 1)
+        for year, month in ((now.year, now.month), previous):
+            file = os.path.join(self.out_dir, '{:04d}'.format(year),
+                '{:02d}'.format(month), '{},{}.csv'.format(
+                    substance.station.name, substance.name))
+            if archive.exists(file):
+                last = last_time(archive.read(file), self.separator)
+                if last is not None:
+                    return row_datetime(last)
+
+    def shortest_last(self, span):
+        # Value of the shortest "last ..." option covering span
+        options = [(s, value) for value, s in self.last_options if s >= span]
+        return min(options)[1] if options else None
 
     def load_substance_data(self, substance):
+        self.substance = substance
+        # Only fields which differ from the server side state are posted
+        if self._select_substance(substance):
+            page = self._get_string()
+            if substance.accuracy is None or not self._catalog_is_fresh():
+                self._set_accuracy(substance, page)
+        if self._select_average(substance):
+            self._get_string()
+        if self._select_time():
+            self._get_string()
+
+    def _select_substance(self, substance):
         # Set substance
         log.info("Processing substance %s", substance.name)
-        self._post_data[uws.TARGET] = uws.SUBSTANCES_KEY
         self._post_data[uws.SUBSTANCES_KEY] = substance.id
-        soup = self._get_string()
-
-        self.substance = substance
+        return self._postback(uws.SUBSTANCES_KEY, substance.id)
 
+    def _set_accuracy(self, substance, page):
         # Select best accuracy possible (hourly, daily, monthly)
-        accuracies = [x['value'] for x in
-            soup.find(id=uws.AVERAGE_ID).find_all('option')]
+        accuracies = [value for value, name in page.options(uws.AVERAGE_ID)]
         for acc in uws.ACCURACY:
             if acc in accuracies:
                 substance.accuracy = acc
                 break
+        if self.catalog is not None:
+            self.catalog.set_accuracy(substance.station.id, substance.id,
+                substance.accuracy)
 
-        self._post_data[uws.TARGET] = uws.AVERAGE_KEY
+    def _select_average(self, substance):
         self._post_data[uws.AVERAGE_KEY] = substance.accuracy
         log.debug('Setting average to: %s', substance.accuracy)
-        self._get_string()
-        
-        self._post_data[uws.TARGET] = uws.TIME_KEY
-        self._post_data.update(dict(uws.set_time_params(
-            (self.year, self.month), (self.end_year, self.end_month))))
+        return self._postback(uws.AVERAGE_KEY, substance.accuracy)
+
+    def _select_time(self):
+        params = uws.set_time_params((self.year, self.month, self.day),
+            (self.end_year, self.end_month), self.last)
+        self._post_data.update(dict(params))
 
         log.debug('Setting time limits: %s-%s', self.month, self.year)
-        self._get_string()
+        return self._postback(uws.TIME_KEY, tuple(params))
+
+    def _postback(self, key, value):
+        # Tell whether the server needs a postback to set key to value
+        self._post_data[uws.TARGET] = key
+        if self._form_state.get(key) == value:
+            return False
+        # Until the answer is parsed the server state is unknown for this
+        # field and all fields depending on it
+        for k in uws.FORM_ORDER[uws.FORM_ORDER.index(key):]:
+            self._form_state.pop(k, None)
+        self._pending = (key, value)
+        return True
         
     def get_csv_data(self):
+        files = self._csv_files()
+        if files is None:
+            return
+        with metrics.timer('download_seconds'):
+            try:
+                self._save_csv(files, self._get_string(raw = True))
+                metrics.inc('downloads_total', status = 'ok')
+            except:
+                self._save_error(files)
+                metrics.inc('downloads_total', status = 'error')
+            finally:
+                self._post_data.pop(uws.BUTTON, None)
+
+    def _csv_files(self):
         self._post_data[uws.BUTTON] = uws.BUTTON_VALUE
         
         self._post_data[uws.TARGET] = ''
         log.info('Downloading data...')
-        dir_path = '{}/{}/{}'.format(self.out_dir, self.year, self.month)
-        file = '{},{}'.format(self.substance.station.name, self.substance.name)
-        file = os.path.join(dir_path, file)
-        if not is_safe_path(self.basedir, file):
-            log.error('*** Directory traversal attack: %s\n%s',
-                file, self.substance)
+        # One file per month, even if several months are downloaded at once
+        files = {}
+        for year, month in self.periods:
+            dir_path = '{}/{}/{}'.format(self.out_dir, year, month)
+            file = '{},{}'.format(
+                self.substance.station.name, self.substance.name)
+            file = os.path.join(dir_path, file)
+            if not is_safe_path(self.basedir, file):
+                log.error('*** Directory traversal attack: %s\n%s',
+                    file, self.substance)
+                self._post_data.pop(uws.BUTTON, None)
+                return
+
+            os.makedirs(dir_path, exist_ok = True)
+            files[(year, month)] = file
+        return files
+
+    def _save_csv(self, files, data):
+        data = data.replace('n. def.', '').replace(',', '.').replace(
+            '; ', self.separator)
+        ext = 'csv' if data[0] != '<' else 'html'
+        if ext == 'csv' and (len(files) > 1 or self.recent):
+            parts = split_by_month(data, self.separator)
+        else:
+            parts = dict((period, data) for period in files)
+        for period, file in files.items():
+            # Months without any row still get the header
+            part = parts[period] if period in parts else parts['header']
+            if ext == 'csv' and self.recent:
+                part = merge_recent('{}.csv'.format(file), part,
+                    self.separator)
+            elif ext == 'csv' and self.day != '01':
+                part = merge_tail('{}.csv'.format(file), part, self.day,
+                    self.separator)
+            if ext == 'csv' and self.use_archive:
+                self.written.update(archive.write('{}.csv'.format(file), part))
+            else:
+                self._write('{}.{}'.format(file, ext), part)
+            if ext == 'csv':
+                # Forget about earlier failures for this month
+                for old in ('err', 'html'):
+                    if os.path.exists('{}.{}'.format(file, old)):
+                        os.remove('{}.{}'.format(file, old))
+                        self.written.add('{}.{}'.format(file, old))
+                self.touched.add(period)
+            self._record(period, OK if ext == 'csv' else HTML, part)
+
+    def _save_error(self, files):
+        log.warning('*** Error downloading %s', self.substance)
+        for period, file in files.items():
+            self._write('{}.{}'.format(file, 'err'), traceback.format_exc())
+            self._record(period, ERROR)
+
+    def _write(self, path, data):
+        # Downloads with the same content as before leave the file alone
+        if os.path.exists(path):
+            with open(path, 'r', newline = '') as f:
+                if f.read() == data:
+                    return
+        with open(path, 'w') as f:
+            f.write(data)
+        self.written.add(path)
+
+    def _record(self, period, status, data = None):
+        if self.manifest is None:
             return
+        self.manifest.record(self.substance.station.name,
+            self.substance.name, period, self.substance.accuracy, status,
+            data, last_time(data, self.separator) if status == OK else None)
+
+    def _get_string(self, raw = False):
+        # The server keeps the form state of a session and only accepts
+        # the ViewState of its latest page: a postback whose answer got
+        # lost cannot just be sent again. Requests failing even after the
+        # retries of the transport, and those answered with a session
+        # error page, are sent again on a new server session after
+        # replaying the postbacks leading up to them.
+        kind = 'csv' if raw else 'page'
+        try:
+            saved = None
+            for attempt in range(self.replays + 1):
+                try:
+                    if attempt > 0:
+                        # A replay failing half way must not change the request
+                        saved = saved or self._save_request()
+                        metrics.inc('retries_total', kind = 'replay')
+                        self._replay(saved)
+                    response = self._request(kind)
+                except requests.RequestException:
+                    if attempt == self.replays:
+                        raise
+                    log.warning('*** Request failed, replaying the form state')
+                    continue
+                if uws.is_session_error(response.text) and \
+                        attempt < self.replays:
+                    log.warning('*** Session lost, replaying the form state')
+                    continue
+                break
+            self._count_response(kind, len(response.content))
+            if raw:
+                return response.text
+            return self._parse(response.text)
+        finally:
+            # Answered or not, the postback is over. Fields it left unknown
+            # are posted again next time.
+            self._pending = None
 
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
+    def _request(self, kind):
+        start = time.perf_counter()
         try:
-            data = self._get_string(raw = True).replace(
-                'n. def.', '').replace(',', '.').replace(
-                    '; ', separator)
-            del self._post_data[uws.BUTTON]
-            ext = 'csv' if data[0] != '<' else 'html'
-            with open('{}.{}'.format(file, ext), 'w') as f:
-                f.write(data)
+            return self._transport.post(self.url, self._post_data, kind)
         except:
-            log.warning('*** Error downloading %s', self.substance)
-            with open('{}.{}'.format(file, 'err'), 'w') as f:
-                f.write(traceback.format_exc())
+            metrics.inc('http_requests_total', kind = kind, status = 'error')
+            raise
+        finally:
+            metrics.observe('http_request_seconds',
+                time.perf_counter() - start, kind = kind)
 
-    def _get_string(self, raw = False):
-        response = self._session.post(uws.URL, self._post_data, timeout = 45)
-        response.raise_for_status()
-        if raw:
-            return response.text
-        soup = BeautifulSoup(response.text, 'html.parser')
-        for vd in (uws.VALIDATION, uws.VIEWSTATE, uws.VIEWSTATEGEN,
-                '__SCROLLPOSITIONX', '__SCROLLPOSITIONY',
-                '__EVENTARGUMENT', '__LASTFOCUS'):
-            el = soup.find(id = vd)
-            if el is not None:
-                self._post_data[vd] = el['value']
-        return soup
+    def _replay(self, saved):
+        # Start a new server session and post the fields the server knew
+        # in form order, then bring the request that failed up to date
+        for step in self._start_replay(saved):
+            self._replay_step(*step)
+            response = self._request('page')
+            self._count_response('page', len(response.content))
+            self._parse(response.text)
+        self._end_replay(saved)
+
+    def _save_request(self):
+        # The request that failed and the postbacks the server had seen
+        return (dict(self._post_data), self._pending,
+            [(key, self._form_state[key]) for key in uws.FORM_ORDER
+                if key in self._form_state])
+
+    def _start_replay(self, saved):
+        # Postbacks to replay, the first one loads the page
+        log.info('Replaying %d postbacks on a new session', len(saved[2]))
+        self._clear_cookies()
+        self._form_state.clear()
+        self._pending = None
+        self._post_data.clear()
+        return [(None, None)] + saved[2]
+
+    def _replay_step(self, key, value):
+        if key is None:
+            return
+        # Fields after this one are reset by it, they are posted next
+        self._post_data.update(value if key == uws.TIME_KEY else
+            [(key, value)])
+        self._post_data[uws.TARGET] = key
+        self._pending = (key, value)
+
+    def _end_replay(self, saved):
+        request, pending = dict(saved[0]), saved[1]
+        for field in STATE_FIELDS:
+            if field in self._post_data:
+                request[field] = self._post_data[field]
+        self._post_data.clear()
+        self._post_data.update(request)
+        self._pending = pending
+
+    def _clear_cookies(self):
+        self._transport.clear()
+
+    def _count_response(self, kind, size):
+        metrics.inc('http_requests_total', kind = kind, status = 'ok')
+        metrics.inc('http_response_bytes_total', size, kind = kind)
+        if kind == 'csv':
+            return
+        # Postbacks by form field, and by substance for the fields that
+        # are set for a substance
+        field = self._pending[0].split('$')[-1] if self._pending else 'page'
+        substance = self.substance.name if self.substance is not None and \
+            self._pending and self._pending[0] != uws.STATIONS_KEY else ''
+        metrics.inc('postbacks_total', field = field, substance = substance)
+
+    def _parse(self, text):
+        # The postback went through, remember the new server side state
+        if self._pending is not None:
+            self._form_state[self._pending[0]] = self._pending[1]
+            self._pending = None
+        with metrics.timer('parse_seconds'):
+            page = FormPage.parse(text)
+        for vd in STATE_FIELDS:
+            value = page.field(vd)
+            if value is not None:
+                self._post_data[vd] = value
+        return page
 
 
 def main(date = '09-2016', end_date = None, out_dir = '.',
-        basedir = os.getcwd()):
+        basedir = os.getcwd(), workers = 1, rate = None, use_async = False,
+        deadline = 45, months = 1, resume = False, url = uws.URL,
+        catalog = None, catalog_ttl = 7, gaps = None, use_archive = False,
+        retries = 3, backoff = 0.5, separator = ','):
     if end_date is None:
         end_date = date
     start = [int(i) for i in date.split('-')]
     end = [int(i) for i in end_date.split('-')]
-    def periods():
-        periods = []
-        for year in range(start[1], end[1] + 1):
+    manifest = None
+    if resume:
+        os.makedirs(out_dir, exist_ok = True)
+        manifest = Manifest.load(os.path.join(out_dir, 'manifest.json'))
+    if gaps is not None:
+        try:
+            from .gaps import Report
+        except:
+            from gaps import Report
+        # Only the gaps of the report, whatever months were asked for
+        gaps = Report.load(gaps).queue()
+        periods = sorted(set(p for m in gaps.values() for p in m))
+        log.info('Downloading %d gaps', sum(len(m) for m in gaps.values()))
+    else:
+        periods = [(year, month)
+            for year in range(start[1], end[1] + 1)
             for month in range(
-                    1 if year != start[1] else start[0],
-                    (12 if year != end[1] else end[0]) + 1):
-                yield (year, month)
-    h = LuftOnlineSiteConfig(out_dir = out_dir, basedir = basedir)
-    h.get_live_data(periods())
+                1 if year != start[1] else start[0],
+                (12 if year != end[1] else end[0]) + 1)]
+    if catalog is not None:
+        catalog = Catalog.load(catalog,
+            ttl = datetime.timedelta(days = catalog_ttl))
+    if use_async:
+        try:
+            from .aioimporter import AsyncSiteConfig
+        except:
+            from aioimporter import AsyncSiteConfig
+        h = AsyncSiteConfig(out_dir = out_dir, basedir = basedir,
+            sessions = workers, rate = rate, deadline = deadline,
+            max_months = months, manifest = manifest, url = url,
+            catalog = catalog, gaps = gaps, use_archive = use_archive,
+            retries = retries, backoff = backoff, separator = separator)
+    elif workers > 1 or rate:
+        try:
+            from .parallel import ParallelSiteConfig
+        except:
+            from parallel import ParallelSiteConfig
+        h = ParallelSiteConfig(out_dir = out_dir, basedir = basedir,
+            workers = workers, rate = rate, max_months = months,
+            manifest = manifest, url = url, catalog = catalog, gaps = gaps,
+            use_archive = use_archive, deadline = deadline,
+            retries = retries, backoff = backoff, separator = separator)
+    else:
+        h = LuftOnlineSiteConfig(out_dir = out_dir, basedir = basedir,
+            max_months = months, manifest = manifest, url = url,
+            catalog = catalog, gaps = gaps, use_archive = use_archive,
+            separator = separator, transport = Transport(retries = retries,
+                backoff = backoff, timeout = deadline))
+    h.get_live_data(periods)
+    # Paths changed by the downloads
+    return h.written
 
 separator = ','
 if __name__ == '__main__':
@@ -219,6 +780,48 @@ given interval (both months included). If --end-date is not passed, only the
 month given in --date will be downloaded.
 
 File separator can be specified with --separator SEPARATOR, it defaults to ','.
+
+Use --workers N to download with N independent sessions in parallel and
+--rate R to cap the total number of requests per second of all sessions,
+retries included. A station failing for good is started again once on a new
+session.
+
+With --async all sessions share one event loop and --workers sets the upper
+bound of sessions, the number of requests in flight adapts itself to the
+response times of the server. --rate caps the requests per second there as
+well.
+
+--deadline sets the time limit in seconds for each single request. Requests
+failing on the way (connection errors, timeouts, busy answers) are sent again
+up to --retries times, waiting a random time of up to --backoff seconds,
+doubled for every further retry. Requests failing after that, and downloads
+answered with a page, are sent again on a new server session once the form
+state (station, substance, average, time) has been replayed. Responses are
+asked for gzip compressed, connections are kept alive.
+
+--months N downloads up to N consecutive months with a single request, the
+result is split into the usual one file per month.
+
+With --resume a manifest.json in the output directory keeps track of all
+downloads. Months which were downloaded completely are skipped, failed
+downloads are repeated and months downloaded before they ended are only
+completed with the missing days.
+
+With --catalog FILE the stations and substances are remembered in FILE and
+only read from the site again after --catalog-ttl days. Stations with
+nothing left to download according to the manifest are then skipped
+without any request.
+
+--gaps FILE downloads the gaps of a report of gaps.py again instead of
+--date and --end-date: the end of every month from its first broken day on.
+
+With --archive the csv files are kept gzip compressed below objects/ of the
+output directory, named by the hash of their content, and every month holds
+an index.json of its files instead. Downloads with the same content as
+before only point to the same object. See archive.py.
+
+--url points the importer to another server, e.g. the stand-in of the
+benchmarks directory.
 """)
     parser.add_option(
         "-d", "--date",
@@ -248,7 +851,101 @@ File separator can be specified with --separator SEPARATOR, it defaults to ','.
         default = separator,
         help = u"Separator for the csv",
     )
+    parser.add_option(
+        "-w", "--workers",
+        dest = "workers",
+        type = "int",
+        default = 1,
+        help = u"Number of sessions downloading in parallel",
+    )
+    parser.add_option(
+        "-r", "--rate",
+        dest = "rate",
+        type = "float",
+        default = None,
+        help = u"Maximum number of requests per second for all sessions",
+    )
+    parser.add_option(
+        "-a", "--async",
+        action = 'store_true',
+        dest = "use_async",
+        default = False,
+        help = u"Download with asyncio and an adaptive concurrency limit",
+    )
+    parser.add_option(
+        "--deadline",
+        dest = "deadline",
+        type = "float",
+        default = 45,
+        help = u"Time limit in seconds for each request",
+    )
+    parser.add_option(
+        "--retries",
+        dest = "retries",
+        type = "int",
+        default = 3,
+        help = u"Number of times a failed request is sent again",
+    )
+    parser.add_option(
+        "--backoff",
+        dest = "backoff",
+        type = "float",
+        default = 0.5,
+        help = u"Seconds to wait at most before the first retry",
+    )
+    parser.add_option(
+        "-m", "--months",
+        dest = "months",
+        type = "int",
+        default = 1,
+        help = u"Number of months to download with a single request",
+    )
+    parser.add_option(
+        "--resume",
+        action = 'store_true',
+        dest = "resume",
+        default = False,
+        help = u"Only download what is missing according to the manifest",
+    )
+    parser.add_option(
+        "-c", "--catalog",
+        dest = "catalog",
+        default = None,
+        help = u"File to keep the stations and substances in",
+    )
+    parser.add_option(
+        "--catalog-ttl",
+        dest = "catalog_ttl",
+        type = "float",
+        default = 7,
+        help = u"Days after which the catalog is read from the site again",
+    )
+    parser.add_option(
+        "-g", "--gaps",
+        dest = "gaps",
+        default = None,
+        help = u"Report of gaps.py to download the gaps of",
+    )
+    parser.add_option(
+        "--archive",
+        action = 'store_true',
+        dest = "use_archive",
+        default = False,
+        help = u"Keep the csv files compressed in a content addressed archive",
+    )
+    parser.add_option(
+        "-u", "--url",
+        dest = "url",
+        default = uws.URL,
+        help = u"Address of recherche.aspx",
+    )
   
     (options, arguments) = parser.parse_args()
-    separator = options.separator
-    main(options.date, options.end_date, options.out_dir)
+    main(options.date, options.end_date, options.out_dir,
+        workers = options.workers, rate = options.rate,
+        use_async = options.use_async, deadline = options.deadline,
+        months = options.months, resume = options.resume, url = options.url,
+        catalog = options.catalog, catalog_ttl = options.catalog_ttl,
+        gaps = options.gaps, use_archive = options.use_archive,
+        retries = options.retries, backoff = options.backoff,
+        separator = options.separator)
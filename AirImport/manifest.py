@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, time, datetime, json, hashlib
+import threading
+import logging
+log = logging.getLogger('uws')
+
+# Status of a download as recorded in the manifest
+OK = 'ok'
+ERROR = 'err'
+HTML = 'html'
+
+@attr.s
+class Manifest(object):
+    # Keeps track of every raw file downloaded to out_dir, keyed by its path
+    # relative to out_dir (YYYY/MM/station,substance)
+    path = attr.ib()
+    entries = attr.ib(default = attr.Factory(dict))
+    # Seconds between two saves while recording, flush() saves the rest
+    interval = attr.ib(default = 30)
+
+    _lock = attr.ib(default = attr.Factory(threading.RLock))
+    _dirty = attr.ib(default = False)
+    _saved = attr.ib(default = attr.Factory(time.monotonic))
+
+    @classmethod
+    def load(cls, path):
+        manifest = cls(path = path)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                manifest.entries = json.load(f)
+        return manifest
+
+    def save(self):
+        # Write to a temporary file first, an interrupted run must not
+        # leave a broken manifest behind
+        with self._lock:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent = 1, sort_keys = True)
+            os.replace(tmp, self.path)
+            self._dirty = False
+            self._saved = time.monotonic()
+
+    def flush(self):
+        # Save what was recorded since the last save
+        with self._lock:
+            if self._dirty:
+                self.save()
+
+    @staticmethod
+    def key(station, substance, period):
+        return '{:04d}/{:02d}/{},{}'.format(
+            int(period[0]), int(period[1]), station, substance)
+
+    def get(self, station, substance, period):
+        return self.entries.get(self.key(station, substance, period))
+
+    def record(self, station, substance, period, accuracy, status,
+            data = None, last = None):
+        entry = dict(
+            accuracy = accuracy,
+            status = status,
+            fetched = datetime.datetime.now().isoformat(),
+        )
+        if data is not None:
+            entry['size'] = len(data.encode('utf-8'))
+            entry['sha1'] = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            entry['last'] = last
+        with self._lock:
+            self.entries[self.key(station, substance, period)] = entry
+            self._dirty = True
+            if time.monotonic() - self._saved >= self.interval:
+                self.save()
+
+    def is_complete(self, station, substance, period):
+        # A month is complete once it was downloaded without errors after
+        # it had ended
+        entry = self.get(station, substance, period)
+        if entry is None or entry['status'] != OK:
+            return False
+        fetched = datetime.datetime.strptime(
+            entry['fetched'][:19], '%Y-%m-%dT%H:%M:%S')
+        year, month = int(period[0]), int(period[1])
+        end = datetime.datetime(
+            year = year + month // 12, month = month % 12 + 1, day = 1)
+        return fetched >= end
+
+    def tail_day(self, station, substance, period):
+        # First day that has to be downloaded again for an incomplete month,
+        # None if the whole month is needed
+        entry = self.get(station, substance, period)
+        if entry is None or entry['status'] != OK or not entry.get('last'):
+            return None
+        last = entry['last']
+        # Monthly data (mm-yyyy) can not be downloaded partially
+        if len(last) < 8:
+            return None
+        return int(last[:2])
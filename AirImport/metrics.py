@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, time, json
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+log = logging.getLogger('uws')
+
+# Prefix of every metric in the Prometheus output
+PREFIX = 'luftqualitaet_'
+# Upper bounds in seconds of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+@attr.s
+class Histogram(object):
+    buckets = attr.ib(default = BUCKETS)
+    # Observations per bucket, the last one is +Inf
+    counts = attr.ib(default = None)
+    sum = attr.ib(default = 0.0)
+    count = attr.ib(default = 0)
+
+    def __attrs_post_init__(self):
+        if self.counts is None:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+@attr.s
+class Registry(object):
+    # Keyed by (name, sorted label items)
+    counters = attr.ib(default = attr.Factory(dict))
+    histograms = attr.ib(default = attr.Factory(dict))
+
+    _lock = attr.ib(default = attr.Factory(threading.Lock))
+
+    def inc(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        # Plain data, also used to hand metrics over from other processes
+        with self._lock:
+            return dict(
+                counters = [dict(name = name, labels = dict(labels),
+                        value = value)
+                    for (name, labels), value in sorted(
+                        self.counters.items())],
+                histograms = [dict(name = name, labels = dict(labels),
+                        buckets = list(h.buckets) + ['+Inf'],
+                        counts = list(h.counts), sum = h.sum, count = h.count)
+                    for (name, labels), h in sorted(
+                        self.histograms.items(), key = lambda i: i[0])],
+            )
+
+    def merge(self, snapshot):
+        with self._lock:
+            for c in snapshot['counters']:
+                key = (c['name'], tuple(sorted(c['labels'].items())))
+                self.counters[key] = self.counters.get(key, 0) + c['value']
+            for h in snapshot['histograms']:
+                key = (h['name'], tuple(sorted(h['labels'].items())))
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(
+                        buckets = tuple(h['buckets'][:-1]))
+                own = self.histograms[key]
+                own.counts = [a + b for a, b in zip(own.counts, h['counts'])]
+                own.sum += h['sum']
+                own.count += h['count']
+
+    def prometheus(self):
+        # Text exposition format, as read by the node exporter's textfile
+        # collector
+        def labels(items, extra = ()):
+            items = list(items) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace(
+                    '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for k, v in items) + '}'
+        lines, typed = [], set()
+        with self._lock:
+            for (name, items), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+                    typed.add(name)
+                lines.append('{}{}{} {}'.format(PREFIX, name, labels(items),
+                    value))
+            for (name, items), h in sorted(self.histograms.items(),
+                    key = lambda i: i[0]):
+                if name not in typed:
+                    lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                    typed.add(name)
+                total = 0
+                for le, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    total += count
+                    lines.append('{}{}_bucket{} {}'.format(PREFIX, name,
+                        labels(items, [('le', le)]), total))
+                lines.append('{}{}_sum{} {}'.format(PREFIX, name,
+                    labels(items), h.sum))
+                lines.append('{}{}_count{} {}'.format(PREFIX, name,
+                    labels(items), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, **summary):
+        # path.json and path.prom, summary values are added to both as
+        # gauges (e.g. run_seconds)
+        snapshot = self.snapshot()
+        snapshot['summary'] = summary
+        text = self.prometheus() + ''.join(
+            '# TYPE {0}{1} gauge\n{0}{1} {2}\n'.format(PREFIX, name, value)
+            for name, value in sorted(summary.items()))
+        # Written under a temporary name first, collectors must never see
+        # a partial file
+        for ext, data in (('json', json.dumps(snapshot, indent = 1)),
+                ('prom', text)):
+            file = '{}.{}'.format(path, ext)
+            with open(file + '.tmp', 'w') as f:
+                f.write(data)
+            os.replace(file + '.tmp', file)
+
+# Shared by all sessions and conversions of a process
+registry = Registry()
+
+def inc(name, value = 1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+def collect(function, *args, **kwargs):
+    # Runs function in a pool process, returns its result along with what
+    # was measured there; the caller merges that into its own registry
+    registry.reset()
+    return function(*args, **kwargs), registry.snapshot()
+
+def pool_map(pool, function, *iterables):
+    # pool.map for a process pool, merging what the processes measured
+    iterables = [list(i) for i in iterables]
+    for result, snapshot in pool.map(collect,
+            [function] * len(iterables[0]), *iterables):
+        registry.merge(snapshot)
+        yield result
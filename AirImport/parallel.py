@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os
+import threading, time
+import logging
+log = logging.getLogger('uws')
+
+from queue import Queue, Empty
+
+try:
+    from . import UmweltSachsen as uws
+    from . import importer
+    from . import metrics
+    from .transport import Transport
+except:
+    import UmweltSachsen as uws
+    import importer
+    import metrics
+    from transport import Transport
+
+@attr.s
+class RateLimiter(object):
+    # Requests per second allowed for all sessions together
+    rate = attr.ib()
+
+    _lock = attr.ib(default = attr.Factory(threading.Lock))
+    _next = attr.ib(default = 0.0)
+
+    def wait(self):
+        # Reserve the next free slot and sleep until it is due
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+@attr.s
+class ParallelSiteConfig(object):
+    workers = attr.ib(default = 4)
+    rate = attr.ib(default = None)
+
+    max_months = attr.ib(default = 1)
+    manifest = attr.ib(default = None)
+    url = attr.ib(default = uws.URL)
+    catalog = attr.ib(default = None)
+    gaps = attr.ib(default = None)
+    use_archive = attr.ib(default = False)
+    # Sessions a station is started again on after an error
+    session_retries = attr.ib(default = 1)
+    # Settings of the transport of every session
+    deadline = attr.ib(default = 45)
+    retries = attr.ib(default = 3)
+    backoff = attr.ib(default = 0.5)
+    separator = attr.ib(default = ',')
+    # Paths changed by all sessions
+    written = attr.ib(default = attr.Factory(set))
+
+    basedir = attr.ib(default = attr.Factory(os.getcwd))
+
+    out_dir = attr.ib(default = attr.Factory(lambda: '.'))
+
+    def get_live_data(self, periods = [(2016, 9)]):
+        limiter = RateLimiter(self.rate) if self.rate else None
+        # A first session finds out which stations exist, it is then
+        # handed over to the first worker
+        site = self._new_site(limiter)
+        site.load_stations()
+
+        # A session handles all periods of a station in one go, so that
+        # it only has to change the time between downloads
+        periods = list(periods)
+        work = Queue()
+        for station in site.stations:
+            work.put((station.id, periods, 0))
+        log.info('Queued %d work items for %d sessions',
+            work.qsize(), self.workers)
+
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target = self._work,
+                args = (work, limiter, site if i == 0 else None))
+            t.start()
+            threads.append(t)
+        try:
+            for t in threads:
+                t.join()
+        finally:
+            if self.manifest is not None:
+                self.manifest.flush()
+
+    def _new_site(self, limiter):
+        # Every session keeps its own cookies and ViewState chain
+        return importer.LuftOnlineSiteConfig(out_dir = self.out_dir,
+            basedir = self.basedir,
+            max_months = self.max_months, manifest = self.manifest,
+            url = self.url, catalog = self.catalog, gaps = self.gaps,
+            use_archive = self.use_archive, written = self.written,
+            separator = self.separator,
+            transport = Transport(retries = self.retries,
+                backoff = self.backoff, timeout = self.deadline,
+                rate_limiter = limiter))
+
+    def _work(self, work, limiter, site = None):
+        while True:
+            try:
+                station_id, periods, attempt = work.get_nowait()
+            except Empty:
+                return
+            try:
+                if site is None:
+                    site = self._new_site(limiter)
+                    site.load_stations()
+                station = [s for s in site.stations if s.id == station_id][0]
+                site.get_station_data(station, periods)
+            except Exception:
+                log.exception('*** Error processing station %s', station_id)
+                metrics.inc('session_errors_total')
+                # Start over with a fresh session, the station included
+                site = None
+                if attempt < self.session_retries:
+                    metrics.inc('retries_total', kind = 'session')
+                    work.put((station_id, periods, attempt + 1))
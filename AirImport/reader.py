@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, datetime, json
+from bisect import bisect_left
+import logging
+log = logging.getLogger('uws')
+
+try:
+    from . import store
+except:
+    import store
+
+# Index of a joint city file, kept as CITY.csv.idx below an index directory
+# or in memory, never next to the published files
+INDEX_EXTENSION = '.idx'
+EPOCH_DAY = datetime.date(1970, 1, 1).toordinal()
+
+def is_safe_path(basedir, path, follow_symlinks=True):
+    # resolves symbolic links
+    if follow_symlinks:
+        return os.path.realpath(path).startswith(basedir)
+    return os.path.abspath(path).startswith(basedir)
+
+def seconds(date, hour):
+    # Same timestamps as binary.py and store.py: 24:00 is 00:00 of the
+    # next day, rows without time of day start at 00:00
+    s = (datetime.date(int(date[:4]), int(date[5:7]),
+        int(date[8:10])).toordinal() - EPOCH_DAY) * 86400
+    if hour:
+        s += int(hour[:2]) * 3600 + int(hour[3:5]) * 60
+    return s
+
+def month_dir(time):
+    # YYYY/MM directory a timestamp is written to. The month before may
+    # still hold it as 24:00 of its last day.
+    time = store.to_datetime(store.epoch(time))
+    return '{:04d}/{:02d}'.format(time.year, time.month)
+
+def previous_month(month):
+    year, month = int(month[:4]), int(month[5:])
+    return '{:04d}/{:02d}'.format(year - (month == 1), (month - 2) % 12 + 1)
+
+def next_month(month):
+    year, month = int(month[:4]), int(month[5:])
+    return '{:04d}/{:02d}'.format(year + (month == 12), month % 12 + 1)
+
+@attr.s
+class JointFile(object):
+    # A city file written by the converter, rows are ordered by time
+    path = attr.ib()
+    # Path of the index, None keeps it in indexes only
+    index_path = attr.ib(default = None)
+    # Rows between two index entries
+    every = attr.ib(default = 256)
+    # Separator the converter wrote the file with
+    separator = attr.ib(default = ',')
+    # In memory indexes by path, shared by the files of a Reader
+    indexes = attr.ib(default = attr.Factory(dict))
+
+    substances = attr.ib(default = None)
+    units = attr.ib(default = None)
+    _entries = attr.ib(default = None)
+    # Offset of the first row
+    _start = attr.ib(default = None)
+
+    def index(self):
+        # (timestamp, byte offset) of every n-th row, rebuilt whenever the
+        # file changed since the index was written
+        if self._entries is not None:
+            return self._entries
+        stat = os.stat(self.path)
+        index = self.indexes.get(self.path)
+        if index is None and self.index_path is not None and \
+                os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        if index is not None and index['mtime'] == stat.st_mtime_ns and \
+                index['size'] == stat.st_size and \
+                index['every'] == self.every:
+            self.indexes[self.path] = index
+            self._set_index(index)
+            return self._entries
+        if index is not None:
+            log.debug('Index of %s is stale', self.path)
+        index = self._build(stat)
+        if self.index_path is not None:
+            tmp = '{}.tmp'.format(self.index_path)
+            with open(tmp, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, self.index_path)
+        self.indexes[self.path] = index
+        self._set_index(index)
+        return self._entries
+
+    def _set_index(self, index):
+        self.substances = index['substances']
+        self.units = index['units']
+        self._entries = [tuple(e) for e in index['entries']]
+        self._start = index['start']
+
+    def _build(self, stat):
+        entries = []
+        with open(self.path, 'rb') as f:
+            substances = f.readline().decode('utf-8').rstrip('\n').split(
+                self.separator)
+            units = f.readline().decode('utf-8').rstrip('\n').split(
+                self.separator)
+            start = offset = f.tell()
+            for i, line in enumerate(iter(f.readline, b'')):
+                # Blank lines are skipped, like by rows()
+                if i % self.every == 0 and line.strip():
+                    date, hour = line.decode('utf-8').split(
+                        self.separator, 2)[:2]
+                    entries.append((seconds(date, hour), offset))
+                offset += len(line)
+        return dict(mtime = stat.st_mtime_ns, size = stat.st_size,
+            every = self.every, substances = substances[2:],
+            units = units[2:], start = start, entries = entries)
+
+    def rows(self, substances = None, start = None, end = None):
+        # (datetime, values of substances) from start up to but excluding
+        # end, None where there is no value
+        entries = self.index()
+        start = store.epoch(start) if start is not None else None
+        end = store.epoch(end) if end is not None else None
+        if substances is None:
+            substances = self.substances
+        columns = [self.substances.index(s) + 2 if s in self.substances
+            else None for s in substances]
+
+        # Rows before the last entry older than start can be skipped
+        offset = self._start
+        if start is not None:
+            i = bisect_left(entries, (start,))
+            if i > 0:
+                offset = entries[i - 1][1]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.strip():
+                    continue
+                l = line.decode('utf-8').rstrip('\n').split(self.separator)
+                t = seconds(l[0], l[1])
+                if start is not None and t < start:
+                    continue
+                if end is not None and t >= end:
+                    return
+                yield store.to_datetime(t), [
+                    float(l[c]) if c is not None and c < len(l) and l[c]
+                    else None for c in columns]
+
+@attr.s
+class Reader(object):
+    # Joint files of a directory of YYYY/MM subdirectories
+    data_dir = attr.ib()
+    # Keep the indexes in this directory, they are only kept in memory
+    # otherwise
+    index_dir = attr.ib(default = None)
+    every = attr.ib(default = 256)
+    separator = attr.ib(default = ',')
+    _indexes = attr.ib(default = attr.Factory(dict))
+
+    def open(self, month, city):
+        path = os.path.join(self.data_dir, month, '{}.csv'.format(city))
+        if not is_safe_path(os.path.realpath(self.data_dir), path):
+            raise ValueError('{} is not below {}'.format(path, self.data_dir))
+        if not os.path.exists(path):
+            return None
+        index_path = None
+        if self.index_dir is not None:
+            index_path = os.path.join(self.index_dir, month,
+                '{}.csv{}'.format(city, INDEX_EXTENSION))
+            if not os.path.exists(os.path.dirname(index_path)):
+                os.makedirs(os.path.dirname(index_path))
+        return JointFile(path = path, index_path = index_path,
+            every = self.every, separator = self.separator,
+            indexes = self._indexes)
+
+    def months(self):
+        return sorted(os.path.join(year, month).replace(os.sep, '/')
+            for year in os.listdir(self.data_dir)
+            if os.path.isdir(os.path.join(self.data_dir, year))
+            for month in os.listdir(os.path.join(self.data_dir, year))
+            if os.path.isdir(os.path.join(self.data_dir, year, month)))
+
+    def read(self, city, substances, start = None, end = None):
+        # (datetime, values) of the substances of city, across months
+        available = self.months()
+        if start is not None:
+            first = previous_month(month_dir(start))
+            available = [m for m in available if m >= first]
+        if end is not None:
+            last = month_dir(end)
+            available = [m for m in available if m <= last]
+        for month in available:
+            joint = self.open(month, city)
+            if joint is not None:
+                for row in joint.rows(substances, start, end):
+                    yield row
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.addHandler(StreamHandler(sys.stderr))
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Prints the values of --city for the comma separated --substances from --from
+up to --to (YYYY-MM-DD[ HH:MM]) out of the joint files below --data-dir, which
+holds the YYYY/MM subdirectories written by the converter.
+
+Every file read gets an index of the byte offset of every --every'th row,
+kept in memory or stored below --index-dir as YYYY/MM/CITY.csv.idx, the
+joint files are left alone. Only the rows of the requested range are read.
+Indexes are built again when their file changed.
+
+The joint files are read with --separator, the one they were converted with.
+""")
+
+    parser.add_option(
+        "-d", "--data-dir",
+        dest = "data_dir",
+        default = "data",
+        help = u"Directory of joint YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "-i", "--index-dir",
+        dest = "index_dir",
+        help = u"Directory to keep the indexes in",
+    )
+    parser.add_option(
+        "-s", "--separator",
+        dest = "separator",
+        default = ",",
+        help = u"Separator of the joint files",
+    )
+    parser.add_option(
+        "-c", "--city",
+        dest = "city",
+        help = u"City to print values of",
+    )
+    parser.add_option(
+        "--substances",
+        dest = "substances",
+        help = u"Comma separated substances to print",
+    )
+    parser.add_option(
+        "--from",
+        dest = "start",
+        help = u"First time to print",
+    )
+    parser.add_option(
+        "--to",
+        dest = "end",
+        help = u"Time to stop printing at",
+    )
+    parser.add_option(
+        "-n", "--every",
+        dest = "every",
+        type = "int",
+        default = 256,
+        help = u"Rows between two index entries",
+    )
+
+    (options, arguments) = parser.parse_args()
+    if not options.city or not options.substances:
+        parser.error(u'Call with --city CITY --substances NO2,PM10')
+
+    substances = options.substances.split(',')
+    reader = Reader(data_dir = options.data_dir,
+        index_dir = options.index_dir, every = options.every,
+        separator = options.separator)
+    print(','.join(['Zeit'] + substances))
+    for t, values in reader.read(options.city, substances,
+            options.start, options.end):
+        print(','.join([t.strftime('%Y-%m-%d %H:%M')] +
+            ['' if v is None else str(v) for v in values]))
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import logging
+log = logging.getLogger('uws')
+
+import numpy as np
+
+try:
+    from . import reader
+    from . import store
+    from . import metrics
+except:
+    import reader
+    import store
+    import metrics
+
+RESOLUTIONS = ('hour', 'day', 'month')
+
+def version(path):
+    # Changes whenever the converter writes the file again
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+@attr.s
+class Series(object):
+    # Typed columns of a joint city file
+    substances = attr.ib()
+    units = attr.ib()
+    # int64 seconds as in reader.py, whether the row has a time of day
+    times = attr.ib()
+    timed = attr.ib()
+    # float64 (substances x rows), NaN where there is no value
+    values = attr.ib()
+
+    @classmethod
+    def load(cls, path, separator = ','):
+        times, timed, rows = [], [], []
+        with open(path, 'rb') as f:
+            substances = f.readline().decode('utf-8').rstrip('\n').split(
+                separator)[2:]
+            units = f.readline().decode('utf-8').rstrip('\n').split(
+                separator)[2:]
+            for line in f:
+                if not line.strip():
+                    continue
+                l = line.decode('utf-8').rstrip('\n').split(separator)
+                times.append(reader.seconds(l[0], l[1]))
+                timed.append(bool(l[1]))
+                rows.append([float(v) if v else np.nan
+                    for v in (l[2:] + [''] * len(substances))[
+                        :len(substances)]])
+        metrics.inc('rows_parsed_total', len(rows))
+        return cls(substances = substances, units = units,
+            times = np.array(times, dtype = np.int64),
+            timed = np.array(timed, dtype = bool),
+            values = np.array(rows, dtype = np.float64).reshape(
+                len(rows), len(substances)).T.copy())
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.timed.nbytes + self.values.nbytes
+
+@attr.s
+class Cache(object):
+    # Least recently used entries are dropped once all of them take more
+    # than max_bytes. An entry is only used while its version is the one
+    # asked for, e.g. the version() of the file it was read from.
+    max_bytes = attr.ib(default = 64 << 20)
+
+    _entries = attr.ib(default = attr.Factory(OrderedDict))
+    _bytes = attr.ib(default = 0)
+    _lock = attr.ib(default = attr.Factory(threading.Lock))
+
+    def get(self, key, version, load):
+        # load() returns (value, size in bytes)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                metrics.inc('cache_hits_total')
+                return entry[1]
+        metrics.inc('cache_misses_total')
+        # Loaded without the lock, two threads may load the same entry
+        value, size = load()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size <= self.max_bytes:
+                self._entries[key] = (version, value, size)
+                self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last = False)[1][2]
+                metrics.inc('cache_evictions_total')
+        return value
+
+    def size(self):
+        with self._lock:
+            return len(self._entries), self._bytes
+
+def resample(times, timed, values, resolution):
+    # Means per day (hours belong to the day they end in, like in
+    # aggregates.py) or per month, and the labels of the rows
+    if resolution == 'hour':
+        days = times.astype('datetime64[s]')
+        labels = np.where(timed, np.datetime_as_string(days, unit = 'm'),
+            np.datetime_as_string(days, unit = 'D'))
+        return np.char.replace(labels, 'T', ' '), values
+    days = np.where(timed, (times - 1) // 86400, times // 86400).astype(
+        'datetime64[D]')
+    if resolution == 'month':
+        days = days.astype('datetime64[M]')
+    keys, inverse = np.unique(days, return_inverse = True)
+    present = ~np.isnan(values)
+    sums = np.bincount(inverse, np.where(present, values, 0),
+        minlength = len(keys))
+    counts = np.bincount(inverse, present, minlength = len(keys))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        means = sums / counts
+    return np.datetime_as_string(keys), means
+
+@attr.s
+class Service(object):
+    # Queries on the joint files below data_dir
+    data_dir = attr.ib()
+    cache = attr.ib(default = attr.Factory(Cache))
+    # Separator of the joint files
+    separator = attr.ib(default = ',')
+
+    # (versions of data_dir and its year directories, months below them)
+    _month_list = attr.ib(default = None)
+
+    def __attrs_post_init__(self):
+        self.reader = reader.Reader(data_dir = self.data_dir,
+            separator = self.separator)
+
+    def months(self):
+        # reader.months(), listed again only once data_dir or one of its
+        # year directories changed, as adding a month or year changes them
+        cached = self._month_list
+        if cached is not None and all(version(p) == v for p, v in cached[0]):
+            return cached[1]
+        dirs = [self.data_dir] + [os.path.join(self.data_dir, year)
+            for year in os.listdir(self.data_dir)
+            if os.path.isdir(os.path.join(self.data_dir, year))]
+        versions = tuple((p, version(p)) for p in dirs)
+        months = self.reader.months()
+        self._month_list = (versions, months)
+        return months
+
+    def _months(self, start, end):
+        # Same selection as Reader.read
+        months = self.months()
+        if start is not None:
+            first = reader.previous_month(reader.month_dir(start))
+            months = [m for m in months if m >= first]
+        if end is not None:
+            last = reader.month_dir(end)
+            months = [m for m in months if m <= last]
+        return months
+
+    def cities(self):
+        # JSON list of the cities of all months
+        paths = [os.path.join(self.data_dir, m, '_cities.csv')
+            for m in self.months()]
+        paths = [p for p in paths if os.path.exists(p)]
+        def load():
+            names = set()
+            for path in paths:
+                with open(path, 'r') as f:
+                    names.update(l.strip() for l in f if l.strip())
+            body = json.dumps(sorted(names), ensure_ascii = False).encode(
+                'utf-8')
+            return body, len(body)
+        return self.cache.get(('cities',),
+            tuple((p, version(p)) for p in paths), load)
+
+    def series(self, path):
+        def load():
+            series = Series.load(path, self.separator)
+            return series, series.nbytes
+        return self.cache.get(path, version(path), load)
+
+    def query(self, city, substance, start = None, end = None,
+            resolution = 'hour'):
+        # JSON of the values of substance in city from start up to but
+        # excluding end, None if there is no file of city. Answers are
+        # cached along with the files they were read from.
+        if resolution not in RESOLUTIONS:
+            raise ValueError('Unknown resolution {}'.format(resolution))
+        months = self._months(start, end)
+        start = store.epoch(start) if start is not None else None
+        end = store.epoch(end) if end is not None else None
+        joints = [self.reader.open(month, city) for month in months]
+        paths = [j.path for j in joints if j is not None]
+        if not paths:
+            return None
+        def load():
+            times, timed, values, unit = [], [], [], None
+            for path in paths:
+                series = self.series(path)
+                if substance not in series.substances:
+                    continue
+                column = series.substances.index(substance)
+                unit = unit or series.units[column]
+                rows = np.ones(len(series.times), dtype = bool)
+                if start is not None:
+                    rows &= series.times >= start
+                if end is not None:
+                    rows &= series.times < end
+                times.append(series.times[rows])
+                timed.append(series.timed[rows])
+                values.append(series.values[column][rows])
+            if times:
+                labels, means = resample(np.concatenate(times),
+                    np.concatenate(timed), np.concatenate(values), resolution)
+                keep = ~np.isnan(means)
+                rows = [[l, float(v)] for l, v in zip(labels[keep].tolist(),
+                    means[keep].tolist())]
+            else:
+                rows = []
+            body = json.dumps(dict(city = city, substance = substance,
+                    unit = unit, resolution = resolution, rows = rows),
+                ensure_ascii = False).encode('utf-8')
+            return body, len(body)
+        return self.cache.get(('query', city, substance, start, end,
+                resolution), tuple(version(p) for p in paths), load)
+
+def handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+        def send(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type',
+                'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def error(self, status, message):
+            self.send(status, json.dumps(dict(error = message)).encode(
+                'utf-8'))
+
+        def do_GET(self):
+            with metrics.timer('query_seconds'):
+                try:
+                    self.answer()
+                except Exception:
+                    # Answered instead of dropping the connection
+                    log.exception('*** Error answering %s', self.path)
+                    self.error(500, 'Internal error')
+
+        def answer(self):
+            url = urlsplit(self.path)
+            query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+            if url.path == '/cities':
+                return self.send(200, service.cities())
+            if url.path != '/series':
+                return self.error(404, 'Unknown path')
+            if 'city' not in query or 'substance' not in query:
+                return self.error(400, 'city and substance are needed')
+            try:
+                body = service.query(query['city'], query['substance'],
+                    query.get('from'), query.get('to'),
+                    query.get('resolution', 'hour'))
+            except ValueError as e:
+                return self.error(400, str(e))
+            if body is None:
+                return self.error(404, 'Unknown city')
+            self.send(200, body)
+    return Handler
+
+def serve(service, host = '127.0.0.1', port = 0):
+    # Returns the server, serve_forever() answers queries
+    server = ThreadingHTTPServer((host, port), handler(service))
+    server.daemon_threads = True
+    return server
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.addHandler(StreamHandler(sys.stderr))
+    log.setLevel(logging.INFO)
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Answers queries on the joint files below --data-dir, which holds the YYYY/MM
+subdirectories written by the converter with --separator:
+
+  /cities
+      JSON list of all cities
+  /series?city=CITY&substance=NO2[&from=..][&to=..][&resolution=hour]
+      {"city", "substance", "unit", "resolution", "rows": [[time, value]]}
+      from --from up to --to (YYYY-MM-DD[ HH:MM]), as written (hour) or as
+      means per day or month
+
+Parsed files and answers are kept in memory up to --cache-mb, the least
+recently used are dropped first. Both are read again once the converter
+wrote a file again.
+""")
+
+    parser.add_option(
+        "-d", "--data-dir",
+        dest = "data_dir",
+        default = "data",
+        help = u"Directory of joint YYYY/MM subdirectories",
+    )
+    parser.add_option(
+        "-s", "--separator",
+        dest = "separator",
+        default = ",",
+        help = u"Separator of the joint files",
+    )
+    parser.add_option(
+        "--host",
+        dest = "host",
+        default = "127.0.0.1",
+        help = u"Address to listen on",
+    )
+    parser.add_option(
+        "-p", "--port",
+        dest = "port",
+        type = "int",
+        default = 8080,
+        help = u"Port to listen on",
+    )
+    parser.add_option(
+        "--cache-mb",
+        dest = "cache_mb",
+        type = "int",
+        default = 64,
+        help = u"Memory for parsed files and answers, in MiB",
+    )
+
+    (options, arguments) = parser.parse_args()
+    service = Service(data_dir = options.data_dir,
+        cache = Cache(max_bytes = options.cache_mb << 20),
+        separator = options.separator)
+    server = serve(service, options.host, options.port)
+    log.info('Serving %s on http://%s:%d/', options.data_dir,
+        *server.server_address[:2])
+    server.serve_forever()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, json, hashlib
+import logging
+log = logging.getLogger('uws')
+
+try:
+    from . import archive
+except:
+    import archive
+
+# Name of the state file kept next to the joint city files
+FILENAME = '.sources.json'
+
+def sha1(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+@attr.s
+class Sources(object):
+    # Raw files a directory of joint city files was converted from, keyed by
+    # file name, with the cities and (city, substance, unit) columns with
+    # data found in each of them
+    path = attr.ib()
+    files = attr.ib(default = attr.Factory(dict))
+    # Substance columns and cities of the last conversion
+    substances = attr.ib(default = attr.Factory(list))
+    cities = attr.ib(default = attr.Factory(list))
+
+    @classmethod
+    def load(cls, path):
+        sources = cls(path = path)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            sources.files = state['files']
+            sources.substances = [tuple(s) for s in state['substances']]
+            sources.cities = state['cities']
+        return sources
+
+    def save(self):
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(dict(files = self.files,
+                    substances = sorted(self.substances),
+                    cities = sorted(self.cities)),
+                f, indent = 1, sort_keys = True)
+        os.replace(tmp, self.path)
+
+    def is_unchanged(self, filename):
+        entry = self.files.get(os.path.basename(filename))
+        if entry is None:
+            return False
+        # Archived files are named by their hash already
+        digest = archive.digest(filename)
+        if digest is not None:
+            return entry['sha1'] == digest
+        stat = os.stat(filename)
+        if entry['mtime'] == stat.st_mtime_ns and \
+                entry['size'] == stat.st_size:
+            return True
+        # Downloads rewrite files with the same content, compare the hash
+        # before parsing again
+        if entry['size'] == stat.st_size and entry['sha1'] == sha1(filename):
+            entry['mtime'] = stat.st_mtime_ns
+            return True
+        return False
+
+    def record(self, filename, part):
+        # part is a Conversor holding just this file
+        digest = archive.digest(filename)
+        stat = os.stat(filename) if digest is None else None
+        self.files[os.path.basename(filename)] = dict(
+            mtime = stat.st_mtime_ns if stat else None,
+            size = stat.st_size if stat else None,
+            sha1 = digest or sha1(filename),
+            cities = sorted(part.cities),
+            columns = [[city.name, substance, us]
+                for city in part.cities.values()
+                for substance, us in zip(city.substances, city.units)],
+        )
+
+    def cities_of(self, names):
+        return set(c for name in names for c in self.files[name]['cities'])
+
+    def substances_of(self, names):
+        # Replays the order of a full conversion: the unit of the first file
+        # with data for a substance of a city wins
+        seen, substances = set(), set()
+        for name in names:
+            for city, substance, us in self.files[name]['columns']:
+                if (city, substance) not in seen:
+                    seen.add((city, substance))
+                    substances.add((substance, us))
+        return substances
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, datetime
+import sqlite3
+import logging
+log = logging.getLogger('uws')
+
+try:
+    from . import binary
+except:
+    import binary
+
+# Timestamps are seconds since 1970-01-01 in local time, 24:00 being 00:00
+# of the next day, as in binary.py. timed is 0 for daily and monthly values.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS units (
+    city TEXT NOT NULL,
+    substance TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    PRIMARY KEY (city, substance)
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    city TEXT NOT NULL,
+    substance TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    timed INTEGER NOT NULL,
+    value REAL NOT NULL,
+    source INTEGER NOT NULL,
+    PRIMARY KEY (city, substance, time, timed)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measurements_source ON measurements (source);
+'''
+
+def epoch(time):
+    # Seconds of a datetime, date or YYYY-MM-DD[ HH:MM] string
+    if isinstance(time, str):
+        return int(binary.epochs([time])[0][0])
+    if not isinstance(time, datetime.datetime):
+        time = datetime.datetime(time.year, time.month, time.day)
+    return int((time - datetime.datetime(1970, 1, 1)).total_seconds())
+
+def to_datetime(seconds):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds = seconds)
+
+def read_joint(path, separator = ','):
+    # City file written by the converter: substances, units and
+    # (YYYY-MM-DD[ HH:MM], values) rows
+    with open(path, 'r') as f:
+        substances = f.readline().rstrip('\n').split(separator)[2:]
+        units = f.readline().rstrip('\n').split(separator)[2:]
+        rows = [l.rstrip('\n').split(separator) for l in f if l.strip()]
+    times = [r[0] + ' ' + r[1] if r[1] else r[0] for r in rows]
+    return substances, units, times, [r[2:] for r in rows]
+
+@attr.s
+class Store(object):
+    path = attr.ib()
+    # Separator the converter wrote the city files with
+    separator = attr.ib(default = ',')
+
+    _db = attr.ib(default = None)
+
+    @classmethod
+    def open(cls, path, separator = ','):
+        store = cls(path = path, separator = separator)
+        store._db = sqlite3.connect(path)
+        store._db.executescript(SCHEMA)
+        return store
+
+    def close(self):
+        self._db.close()
+
+    def update(self, joint_dir, paths = None):
+        # Load every city file below joint_dir that is new or changed since
+        # the last update, returns the number of files loaded. With paths,
+        # e.g. the files the converter just wrote or removed, only those are
+        # looked at, unless the store is still empty.
+        if paths is not None and self._db.execute(
+                'SELECT 1 FROM sources LIMIT 1').fetchone() is None:
+            paths = None
+        if paths is None:
+            paths = [os.path.join(root, name)
+                for root, dirs, files in sorted(os.walk(joint_dir))
+                for name in sorted(files)]
+        loaded = 0
+        for path in paths:
+            name = os.path.basename(path)
+            if not name.endswith('.csv') or name.startswith('_'):
+                continue
+            if self.update_file(path,
+                    os.path.relpath(path, joint_dir).replace(os.sep, '/')):
+                loaded += 1
+        log.info('Loaded %d files of %s into %s', loaded, joint_dir, self.path)
+        return loaded
+
+    def update_file(self, path, key):
+        row = self._db.execute(
+            'SELECT id, mtime, size FROM sources WHERE path = ?',
+            (key,)).fetchone()
+        city = os.path.splitext(os.path.basename(path))[0]
+        if not os.path.exists(path):
+            return row is not None and self.remove_file(row[0], city)
+        stat = os.stat(path)
+        if row is not None and row[1:] == (stat.st_mtime_ns, stat.st_size):
+            return False
+        substances, units, times, rows = read_joint(path, self.separator)
+        epochs, timed = binary.epochs(times)
+        with self._db:
+            if row is None:
+                source = self._db.execute(
+                    'INSERT INTO sources (path, mtime, size) VALUES (?, ?, ?)',
+                    (key, stat.st_mtime_ns, stat.st_size)).lastrowid
+            else:
+                source = row[0]
+                self._db.execute(
+                    'UPDATE sources SET mtime = ?, size = ? WHERE id = ?',
+                    (stat.st_mtime_ns, stat.st_size, source))
+                # Values no longer in the file must not stay behind
+                self._db.execute('DELETE FROM measurements WHERE source = ?',
+                    (source,))
+            self._db.executemany('INSERT OR REPLACE INTO measurements '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                ((city, substance, t, d, float(v), source)
+                    for t, d, values in zip(epochs.tolist(), timed.tolist(),
+                        rows)
+                    for substance, v in zip(substances, values) if v))
+            used = set(s for values in rows
+                for s, v in zip(substances, values) if v)
+            # The unit of the latest file wins
+            self._db.executemany(
+                'INSERT OR REPLACE INTO units VALUES (?, ?, ?)',
+                [(city, s, u) for s, u in zip(substances, units) if s in used])
+        return True
+
+    def remove_file(self, source, city):
+        # Values of a city file that is gone, and units left without any
+        with self._db:
+            self._db.execute('DELETE FROM measurements WHERE source = ?',
+                (source,))
+            self._db.execute('DELETE FROM sources WHERE id = ?', (source,))
+            self._db.execute('DELETE FROM units WHERE city = ? AND '
+                'substance NOT IN (SELECT DISTINCT substance FROM '
+                'measurements WHERE city = ?)', (city, city))
+        return True
+
+    def query(self, city, substance, start = None, end = None):
+        # (datetime, value) from start up to but excluding end
+        sql = 'SELECT time, value FROM measurements ' \
+            'WHERE city = ? AND substance = ?'
+        args = [city, substance]
+        if start is not None:
+            sql += ' AND time >= ?'
+            args.append(epoch(start))
+        if end is not None:
+            sql += ' AND time < ?'
+            args.append(epoch(end))
+        return [(to_datetime(t), v)
+            for t, v in self._db.execute(sql + ' ORDER BY time, timed', args)]
+
+    def cities(self):
+        return [r[0] for r in self._db.execute(
+            'SELECT DISTINCT city FROM units ORDER BY city')]
+
+    def substances(self, city):
+        # (substance, unit) with data for city
+        return self._db.execute('SELECT substance, unit FROM units '
+            'WHERE city = ? ORDER BY substance', (city,)).fetchall()
+
+if __name__ == '__main__':
+    from logging import StreamHandler
+    import sys
+    log.setLevel(logging.INFO)
+    log.addHandler(StreamHandler(sys.stderr))
+
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Keeps the joint city files of all months in one SQLite database.
+
+With --data-dir DIR, every DIR/YYYY/MM/CITY.csv written by the converter
+that changed since the last call is loaded into --store FILE. The files are
+read with --separator, the one they were converted with.
+
+With --city CITY and --substance SUBSTANCE the values from --from up to
+--to (YYYY-MM-DD[ HH:MM]) are printed as CSV.
+""")
+
+    parser.add_option(
+        "-s", "--store",
+        dest = "store",
+        default = "data.sqlite",
+        help = u"SQLite file to keep the data in",
+    )
+    parser.add_option(
+        "-d", "--data-dir",
+        dest = "data_dir",
+        help = u"Directory of joint YYYY/MM subdirectories to load",
+    )
+    parser.add_option(
+        "--separator",
+        dest = "separator",
+        default = ",",
+        help = u"Separator of the joint files",
+    )
+    parser.add_option(
+        "-c", "--city",
+        dest = "city",
+        help = u"City to print values of",
+    )
+    parser.add_option(
+        "--substance",
+        dest = "substance",
+        help = u"Substance to print values of",
+    )
+    parser.add_option(
+        "--from",
+        dest = "start",
+        help = u"First time to print",
+    )
+    parser.add_option(
+        "--to",
+        dest = "end",
+        help = u"Time to stop printing at",
+    )
+
+    (options, arguments) = parser.parse_args()
+    if not options.data_dir and not (options.city and options.substance):
+        parser.error(u'Call with --data-dir DIR or --city and --substance')
+
+    store = Store.open(options.store, options.separator)
+    if options.data_dir:
+        store.update(options.data_dir)
+    if options.city and options.substance:
+        for t, v in store.query(options.city, options.substance,
+                options.start, options.end):
+            print('{},{}'.format(t.strftime('%Y-%m-%d %H:%M'), v))
+    store.close()
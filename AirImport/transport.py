@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import attr
+
+import time, random
+from email.utils import parsedate_to_datetime
+import logging
+log = logging.getLogger('uws')
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from . import metrics
+except:
+    import metrics
+
+# Answers worth asking again for, the server or a proxy is busy
+TRANSIENT_STATUS = (429, 502, 503, 504)
+
+def delay(attempt, backoff, max_backoff):
+    # Exponential backoff with full jitter: sessions failing together do
+    # not come back together
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+def retry_after(response, default):
+    # Seconds asked for by the server, if any: a number or an HTTP date.
+    # The server knows best, max_backoff does not apply.
+    value = response.headers.get('Retry-After', '').strip() \
+        if response is not None else ''
+    if value.isdigit():
+        return max(default, float(value))
+    try:
+        return max(default, parsedate_to_datetime(value).timestamp() -
+            time.time())
+    except (TypeError, ValueError, IndexError):
+        return default
+
+def new_session(pool_size):
+    # Keep-alive connections to the site are reused and bounded, a
+    # session waits for a free connection instead of opening more
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size,
+        pool_block = True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+@attr.s
+class Transport(object):
+    # Requests of one session (one cookie jar, one ViewState chain).
+    # Connection errors, timeouts and TRANSIENT_STATUS answers are sent
+    # again up to retries times, waiting delay() in between. Other errors
+    # are raised at once.
+    retries = attr.ib(default = 3)
+    # Seconds before the first retry, doubled for every further one
+    backoff = attr.ib(default = 0.5)
+    max_backoff = attr.ib(default = 30.0)
+    timeout = attr.ib(default = 45)
+    pool_size = attr.ib(default = 2)
+    session = attr.ib(default = None)
+    # Optional limiter shared between sessions running in parallel, it is
+    # waited for before every attempt, retries included
+    rate_limiter = attr.ib(default = None)
+
+    def post(self, url, data, kind = 'page'):
+        if self.session is None:
+            self.session = new_session(self.pool_size)
+        for attempt in range(self.retries + 1):
+            response = None
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            try:
+                response = self.session.post(url, data,
+                    timeout = self.timeout)
+                if response.status_code not in TRANSIENT_STATUS:
+                    response.raise_for_status()
+                    self._count_saved(response, kind)
+                    return response
+                reason = str(response.status_code)
+                if attempt == self.retries:
+                    response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                reason = type(e).__name__
+                if attempt == self.retries:
+                    raise
+            wait = retry_after(response, delay(attempt, self.backoff,
+                self.max_backoff))
+            log.warning('Request failed (%s), retrying in %.1f s', reason,
+                wait)
+            metrics.inc('retries_total', kind = 'request')
+            time.sleep(wait)
+
+    def _count_saved(self, response, kind):
+        # Bytes the compression saved, the body is read by now
+        if response.headers.get('Content-Encoding', '') != 'gzip':
+            return
+        wire = response.raw.tell()
+        metrics.inc('http_bytes_saved_total',
+            max(0, len(response.content) - wire), kind = kind)
+
+    def clear(self):
+        # Forget the cookies, the next request starts a new server session
+        if self.session is not None:
+            self.session.cookies.clear()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import os, sys, time, random, string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+from AirImport import UmweltSachsen as uws
+from AirImport.formparser import FormPage
+
+HIDDEN = (uws.VALIDATION, uws.VIEWSTATE, uws.VIEWSTATEGEN,
+    '__SCROLLPOSITIONX', '__SCROLLPOSITIONY', '__EVENTARGUMENT', '__LASTFOCUS')
+SELECTS = (uws.STATIONS_ID, uws.SUBSTANCES_ID, uws.AVERAGE_ID)
+# Recorded pages used when none are given, see run.py
+PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures',
+    'pages')
+
+def synthetic_page(viewstate = 120000, stations = 30, seed = 0):
+    # Page shaped like recherche.aspx, used when there are no recorded pages
+    rnd = random.Random(seed)
+    def blob(n):
+        return ''.join(rnd.choice(string.ascii_letters + string.digits + '+/')
+            for i in range(n))
+    def select(id, options):
+        return '<select name="{}" id="{}" onchange="__doPostBack()">{}' \
+            '</select>\n'.format(id.replace('_', '$'), id, ''.join(
+                '<option value="{}">{}</option>'.format(v, t)
+                for v, t in options))
+    def hidden(id, value):
+        return '<input type="hidden" name="{0}" id="{0}" value="{1}" />\n' \
+            .format(id, value)
+    nav = ''.join(
+        '<li><a href="/umwelt/{0}.htm">Seite {0}</a></li>\n'.format(i)
+        for i in range(200))
+    return ''.join([
+        '<!DOCTYPE html>\n<html><head><title>Luftqualit&auml;t</title>',
+        '<script type="text/javascript">{}</script></head><body>\n'.format(
+            'var x = "<div>";' * 200),
+        '<form method="post" action="recherche.aspx" id="aspnetForm">\n',
+        hidden('__EVENTTARGET', ''), hidden('__EVENTARGUMENT', ''),
+        hidden('__LASTFOCUS', ''), hidden(uws.VIEWSTATE, blob(viewstate)),
+        '<ul class="nav">', nav, '</ul>\n<table>',
+        '<tr><td>', select(uws.STATIONS_ID,
+            [(str(i), 'Station &#246;{}'.format(i)) for i in range(stations)]),
+        '</td></tr>',
+        '<tr><td>', select(uws.SUBSTANCES_ID, [(str(i), s) for i, s in
+            enumerate(['NO2', 'NO', 'PM10', 'PM2.5', 'O3', 'SO2', 'CO'])]),
+        '</td></tr>',
+        '<tr><td>', select(uws.AVERAGE_ID, [(a, a) for a in uws.ACCURACY]),
+        '</td></tr>',
+        select('ctl00_Inhalt_AZTag', [('%02d' % i, i) for i in range(1, 32)]),
+        select('ctl00_Inhalt_AZJahr', [(i, i) for i in range(1990, 2017)]),
+        '</table>\n',
+        hidden(uws.VIEWSTATEGEN, 'CA0B0334'),
+        hidden('__SCROLLPOSITIONX', '0'), hidden('__SCROLLPOSITIONY', '0'),
+        hidden(uws.VALIDATION, blob(viewstate // 20)),
+        '</form></body></html>\n',
+    ])
+
+def with_soup(text):
+    soup = BeautifulSoup(text, 'html.parser')
+    fields = dict((vd, el['value'] if el is not None else None)
+        for vd, el in ((vd, soup.find(id = vd)) for vd in HIDDEN))
+    options = [[(i['value'], i.string)
+        for i in soup.find(id = s).find_all('option')] for s in SELECTS]
+    return fields, options
+
+def with_form_page(text):
+    page = FormPage.parse(text)
+    fields = dict((vd, page.field(vd)) for vd in HIDDEN)
+    options = [page.options(s) for s in SELECTS]
+    return fields, options
+
+def bench(function, pages, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for text in pages:
+            function(text)
+    return (time.perf_counter() - start) / (repeat * len(pages))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(usage = '%prog [options] [PAGE.html ...]', epilog = u"""
+Measures the time needed to read the hidden fields and select lists of a
+postback response, with BeautifulSoup and with AirImport.formparser.
+
+Without arguments the recorded pages of benchmarks/fixtures/pages are used,
+a synthetic page if there are none. Pass pages saved from recherche.aspx to
+measure on those instead.
+""")
+    parser.add_option(
+        "-n", "--repeat",
+        dest = "repeat",
+        type = "int",
+        default = 20,
+        help = u"Number of times every page is parsed",
+    )
+    (options, arguments) = parser.parse_args()
+
+    if not arguments and os.path.isdir(PAGES):
+        arguments = [os.path.join(PAGES, name)
+            for name in sorted(os.listdir(PAGES)) if name.endswith('.html')]
+    pages = [open(f, 'r').read() for f in arguments] or [synthetic_page()]
+    # Both ways must agree on what they extract
+    for text in pages:
+        assert with_soup(text) == with_form_page(text)
+    size = sum(len(p) for p in pages) / len(pages)
+    before = bench(with_soup, pages, options.repeat)
+    after = bench(with_form_page, pages, options.repeat)
+    print('pages: {}, average size: {:.0f} kB'.format(len(pages), size / 1000))
+    print('BeautifulSoup: {:8.3f} ms/response'.format(before * 1000))
+    print('FormPage:      {:8.3f} ms/response'.format(after * 1000))
+    print('speedup:       {:8.1f}x'.format(before / after))
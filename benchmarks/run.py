@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import os, sys, time, datetime, platform, json, hashlib
+import shutil, tempfile
+import tracemalloc
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AirImport import importer, converter
+
+import standin
+import parse
+
+log = logging.getLogger('uws')
+
+# Recorded raw files (raw/YYYY/MM) and postback pages (pages/) used by
+# default, see --fixtures
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'fixtures')
+
+def count_rows(data_dir):
+    # Data rows of all raw files below data_dir
+    rows = 0
+    for root, dirs, files in os.walk(data_dir):
+        for name in files:
+            if name.endswith('.csv'):
+                with open(os.path.join(root, name), 'r') as f:
+                    rows += sum(1 for l in f if l.strip()) - 2
+    return rows
+
+def bench_importer(raw_dir, options):
+    site = standin.Site(stations = options.stations,
+        latency = options.latency, viewstate = options.viewstate)
+    server, url = standin.serve(site)
+    start = time.perf_counter()
+    try:
+        importer.main(options.date, options.end_date, out_dir = raw_dir,
+            basedir = os.path.realpath(raw_dir), workers = options.workers,
+            use_async = options.use_async, months = options.months, url = url)
+    finally:
+        server.shutdown()
+    seconds = time.perf_counter() - start
+    return dict(
+        stations = options.stations,
+        latency = options.latency,
+        workers = options.workers,
+        use_async = options.use_async,
+        months = options.months,
+        requests = site.requests,
+        seconds = seconds,
+        requests_per_s = site.requests / seconds,
+    )
+
+def bench_parse(pages, repeat):
+    soup = parse.bench(parse.with_soup, pages, repeat)
+    form_page = parse.bench(parse.with_form_page, pages, repeat)
+    return dict(
+        pages = len(pages),
+        average_bytes = sum(len(p) for p in pages) // len(pages),
+        soup_ms = soup * 1000,
+        form_page_ms = form_page * 1000,
+    )
+
+def digests(out_dir):
+    # sha1 of every file below out_dir, by relative path
+    result = dict()
+    for root, dirs, files in os.walk(out_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                result[os.path.relpath(path, out_dir)] = hashlib.sha1(
+                    f.read()).hexdigest()
+    return result
+
+def bench_converter(raw_dir, reference = None, **options):
+    # Converts every month of raw_dir twice: once for the time, once under
+    # tracemalloc for the peak memory. The output of the first run is
+    # compared with reference, the digests() of another mode.
+    rows = count_rows(raw_dir)
+    out_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        converter.convert_tree(raw_dir, out_dir = out_dir,
+            basedir = os.path.realpath(out_dir), **options)
+        seconds = time.perf_counter() - start
+        output = digests(out_dir)
+        shutil.rmtree(out_dir)
+        tracemalloc.start()
+        converter.convert_tree(raw_dir, out_dir = out_dir,
+            basedir = os.path.realpath(out_dir), **options)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(out_dir, ignore_errors = True)
+    result = dict(rows = rows, seconds = seconds, rows_per_s = rows / seconds,
+        peak_bytes = peak, digests = output)
+    if reference is not None:
+        result['identical'] = output == reference
+    return result
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Runs the importer against a local stand-in for recherche.aspx (standin.py),
+then parses the recorded postback pages and converts the recorded raw files
+with every converter mode. Prints the results as JSON, or writes them to
+--output so that runs can be compared. "identical" tells whether a mode wrote
+the same files as the default one.
+
+The recorded pages and raw files are read from pages/ and raw/ of
+--fixtures, benchmarks/fixtures by default. Whatever is missing there is
+recorded from the stand-in first: the files the importer downloaded and
+pages as the stand-in answers postbacks. Pages saved from the real site can
+be put into pages/ as well.
+""")
+    parser.add_option(
+        "-o", "--output",
+        dest = "output",
+        help = u"File to write the results to",
+    )
+    parser.add_option(
+        "-f", "--fixtures",
+        dest = "fixtures",
+        default = FIXTURES,
+        help = u"Directory of the recorded fixtures",
+    )
+    parser.add_option(
+        "-d", "--date",
+        dest = "date",
+        default = "01-2016",
+        help = u"First month to download, MM-YYYY",
+    )
+    parser.add_option(
+        "-e", "--end-date",
+        dest = "end_date",
+        default = "03-2016",
+        help = u"Last month to download, MM-YYYY",
+    )
+    parser.add_option(
+        "-n", "--stations",
+        dest = "stations",
+        type = "int",
+        default = 10,
+        help = u"Number of stations of the stand-in",
+    )
+    parser.add_option(
+        "-l", "--latency",
+        dest = "latency",
+        type = "float",
+        default = 0.05,
+        help = u"Seconds every request to the stand-in takes",
+    )
+    parser.add_option(
+        "--viewstate",
+        dest = "viewstate",
+        type = "int",
+        default = 100000,
+        help = u"Size of the ViewState of the stand-in in bytes",
+    )
+    parser.add_option(
+        "-w", "--workers",
+        dest = "workers",
+        type = "int",
+        default = 1,
+        help = u"Sessions of the importer",
+    )
+    parser.add_option(
+        "-a", "--async",
+        action = 'store_true',
+        dest = "use_async",
+        default = False,
+        help = u"Use the asyncio importer",
+    )
+    parser.add_option(
+        "-m", "--months",
+        dest = "months",
+        type = "int",
+        default = 1,
+        help = u"Months downloaded with a single request",
+    )
+    parser.add_option(
+        "-r", "--repeat",
+        dest = "repeat",
+        type = "int",
+        default = 10,
+        help = u"Number of times every page is parsed",
+    )
+    parser.add_option(
+        "-j", "--jobs",
+        dest = "processes",
+        type = "int",
+        default = 1,
+        help = u"Processes of the converter",
+    )
+    (options, arguments) = parser.parse_args()
+    log.addHandler(logging.StreamHandler(sys.stderr))
+    log.setLevel(logging.WARNING)
+
+    raw_dir = os.path.join(options.fixtures, 'raw')
+    pages_dir = os.path.join(options.fixtures, 'pages')
+    download_dir = tempfile.mkdtemp()
+    results = dict(
+        time = datetime.datetime.now().isoformat(),
+        python = platform.python_version(),
+        platform = platform.platform(),
+    )
+    try:
+        results['importer'] = bench_importer(download_dir, options)
+        if not os.path.exists(raw_dir):
+            shutil.copytree(download_dir, raw_dir)
+        if not os.path.exists(pages_dir):
+            # Pages as the stand-in answers postbacks
+            os.makedirs(pages_dir)
+            site = standin.Site(stations = options.stations,
+                viewstate = options.viewstate)
+            for i in range(3):
+                with open(os.path.join(pages_dir, '{}.html'.format(i)),
+                        'w') as f:
+                    f.write(site.page(standin.Session(seq = i,
+                        station = str(i + 1))))
+        pages = [open(os.path.join(pages_dir, name), 'r').read()
+            for name in sorted(os.listdir(pages_dir))]
+        results['parse'] = bench_parse(pages, options.repeat)
+        # Every mode has to write the same files as the default one
+        results['converter'] = dict(default = bench_converter(raw_dir,
+            processes = options.processes))
+        reference = results['converter']['default'].pop('digests')
+        for name, mode in [('columnar', dict(columnar = True)),
+                ('streaming', dict(streaming = True))]:
+            results['converter'][name] = bench_converter(raw_dir,
+                reference, processes = options.processes, **mode)
+            del results['converter'][name]['digests']
+    finally:
+        shutil.rmtree(download_dir)
+
+    text = json.dumps(results, indent = 1, sort_keys = True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import attr
+
+import os, sys, time, datetime, random, base64, gzip
+import threading
+import urllib.parse
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AirImport import UmweltSachsen as uws
+
+# Local stand-in for recherche.aspx. Every session (cookie) has its own
+# form state and ViewState sequence, a postback with a stale ViewState is
+# answered with an error like the real server does.
+
+NAMES = ['Dresden-Nord', 'Dresden-Bergstr.', 'Dresden-Winckelmannstr.',
+    'Leipzig-Mitte', 'Leipzig-Lützner Str.', 'Leipzig-West',
+    'Chemnitz-Mitte', 'Chemnitz-Leipziger Str.', 'Zwickau-Werdauer Str.',
+    'Görlitz', 'Bautzen', 'Plauen-Süd', 'Freiberg', 'Radebeul-Wahnsdorf',
+    'Annaberg-Buchholz', 'Glauchau', 'Klingenthal', 'Zittau-Ost']
+SUBSTANCES = ['NO2', 'NO', 'PM10', 'PM2.5', 'O3', 'SO2', 'CO', 'Benzol']
+UNITS = dict(CO = 'mg/m³')
+AVERAGES = [(uws.ACCURACY[0], 'Stundenmittelwerte'),
+    (uws.ACCURACY[1], 'Tagesmittelwerte'),
+    (uws.ACCURACY[2], 'Monatsmittelwerte')]
+# Options of the "last hours/days" select, 0 is a free period
+LAST = [('0', 'freier Zeitraum'), ('1', 'letzte 24 Stunden'),
+    ('7', 'letzte 7 Tage'), ('31', 'letzte 31 Tage')]
+DAY_KEY = 'ctl00$Inhalt$AZTag'
+MONTH_KEY = 'ctl00$Inhalt$AZMonat'
+YEAR_KEY = 'ctl00$Inhalt$AZJahr'
+END_DAY_KEY = 'ctl00$Inhalt$EZTag'
+END_MONTH_KEY = 'ctl00$Inhalt$EZMonat'
+END_YEAR_KEY = 'ctl00$Inhalt$EZJahr'
+
+def select(id, options, selected):
+    return '<select name="{}" id="{}" onchange="javascript:setTimeout(' \
+        '\'__doPostBack(\\\'{}\\\',\\\'\\\')\', 0)">{}</select>\n'.format(
+        id.replace('_', '$'), id, id.replace('_', '$'), ''.join(
+            '<option{} value="{}">{}</option>'.format(
+                ' selected="selected"' if v == selected else '', v, t)
+            for v, t in options))
+
+def value(station, substance, time):
+    # A time always has the same value, whatever period it is part of
+    rnd = random.Random('{},{},{}'.format(station, substance, time))
+    if rnd.random() < 0.01:
+        return 'n. def.'
+    # Mixed precision like the site: "12", "12,5", "12,25"
+    return '{:g}'.format(round(rnd.uniform(5, 60), rnd.choice((0, 1, 1, 2)))
+        ).replace('.', ',')
+
+def hidden(id, value):
+    return '<input type="hidden" name="{0}" id="{0}" value="{1}" />\n'.format(
+        id, value)
+
+@attr.s
+class Session(object):
+    seq = attr.ib(default = 0)
+    station = attr.ib(default = '1')
+    substance = attr.ib(default = '0')
+    average = attr.ib(default = uws.ACCURACY[0])
+
+@attr.s
+class Site(object):
+    stations = attr.ib(default = 10)
+    # Seconds every request takes at least
+    latency = attr.ib(default = 0.0)
+    # Size of the ViewState in bytes, the real one is around 100 kB
+    viewstate = attr.ib(default = 20000)
+    # Last time with data for "last hours/days" downloads
+    now = attr.ib(default = datetime.datetime(2016, 9, 20, 12))
+    # Share of requests whose answer gets lost after they were handled
+    failures = attr.ib(default = 0.0)
+    # Compress answers for clients asking for gzip
+    compress = attr.ib(default = True)
+
+    requests = attr.ib(default = 0)
+    _sessions = attr.ib(default = attr.Factory(dict))
+    _lock = attr.ib(default = attr.Factory(threading.Lock))
+
+    def station_options(self):
+        return [(str(i + 1), NAMES[i] if i < len(NAMES) else
+            'Messstation {}'.format(i + 1)) for i in range(self.stations)]
+
+    def substance_options(self, station):
+        # Every station measures a different subset
+        i = int(station)
+        return [(str(j), s) for j, s in enumerate(SUBSTANCES)
+            if (i + j) % 3 != 0 or j == 0]
+
+    def handle(self, fields, sid):
+        # (status, session id, content type, body) of a postback
+        time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if sid not in self._sessions:
+                sid = '{:016x}'.format(random.getrandbits(64))
+                self._sessions[sid] = Session()
+            session = self._sessions[sid]
+            viewstate = fields.get(uws.VIEWSTATE)
+            if viewstate is not None and not base64.b64decode(
+                    viewstate).startswith('{}:'.format(session.seq).encode()):
+                return 500, sid, 'text/html', 'Invalid ViewState'
+            target = fields.get(uws.TARGET, '')
+            if target == uws.STATIONS_KEY:
+                session.station = fields[target]
+                session.substance = self.substance_options(
+                    session.station)[0][0]
+            elif target == uws.SUBSTANCES_KEY:
+                session.substance = fields[target]
+            elif target == uws.AVERAGE_KEY:
+                session.average = fields[target]
+            if not fields.get(uws.BUTTON):
+                session.seq += 1
+            # Answers are put together outside of the lock
+            session = attr.evolve(session)
+        if self.failures and random.random() < self.failures:
+            return None, sid, None, None
+        if fields.get(uws.BUTTON):
+            return 200, sid, 'text/csv', self.csv(session, fields)
+        return 200, sid, 'text/html', self.page(session)
+
+    def page(self, session):
+        blob = os.urandom(self.viewstate * 3 // 4)
+        viewstate = base64.b64encode(
+            '{}:'.format(session.seq).encode() + blob).decode()
+        return ''.join([
+            '<!DOCTYPE html>\n<html><head><title>Luftqualit&auml;t</title>'
+            '</head><body>\n<form method="post" action="recherche.aspx" '
+            'id="aspnetForm">\n',
+            hidden(uws.TARGET, ''), hidden('__EVENTARGUMENT', ''),
+            hidden('__LASTFOCUS', ''), hidden(uws.VIEWSTATE, viewstate),
+            '<table><tr><td>',
+            select(uws.STATIONS_ID, self.station_options(), session.station),
+            '</td></tr><tr><td>',
+            select(uws.SUBSTANCES_ID,
+                self.substance_options(session.station), session.substance),
+            '</td></tr><tr><td>',
+            select(uws.AVERAGE_ID, AVERAGES, session.average),
+            '</td></tr><tr><td>',
+            select('ctl00_Inhalt_LetzteList', LAST, '0'),
+            '</td></tr></table>\n',
+            hidden(uws.VIEWSTATEGEN, 'CA0B0334'),
+            hidden(uws.VALIDATION, base64.b64encode(
+                '{}:'.format(session.seq).encode() + blob[:256]).decode()),
+            '<input type="submit" name="{}" value="{}" />\n'.format(
+                uws.BUTTON, uws.BUTTON_VALUE),
+            '</form></body></html>\n',
+        ])
+
+    def csv(self, session, fields):
+        station = dict(self.station_options())[session.station]
+        substance = dict(self.substance_options(session.station))[
+            session.substance]
+        step = datetime.timedelta(
+            seconds = int(session.average.split('; ')[1]))
+        last = fields.get(uws.TIME_KEY, '0')
+        if last not in ('0', ''):
+            end = self.now
+            start = end - datetime.timedelta(days = int(last))
+        else:
+            start = datetime.datetime(int(fields[YEAR_KEY]),
+                int(fields[MONTH_KEY]), int(fields[DAY_KEY]))
+            end = datetime.datetime(int(fields[END_YEAR_KEY]),
+                int(fields[END_MONTH_KEY]), int(fields[END_DAY_KEY]))
+            end = min(end, self.now)
+        rows = ['Datum Zeit; {} {}'.format(station, substance),
+            '; {}'.format(UNITS.get(substance, 'µg/m³'))]
+        if session.average == uws.ACCURACY[2]:
+            # Monthly values
+            month = datetime.datetime(start.year, start.month, 1)
+            while month < end:
+                rows.append('{}; {}'.format(month.strftime('%m-%Y'),
+                    value(station, substance, month)))
+                month = datetime.datetime(month.year + month.month // 12,
+                    month.month % 12 + 1, 1)
+            return '\n'.join(rows) + '\n'
+        t = start + step
+        while t <= end:
+            if step.days:
+                stamp = (t - step).strftime('%d.%m.%y')
+            elif t.hour == 0:
+                # The end of a day is written as 24:00
+                stamp = (t - step).strftime('%d.%m.%y') + ' 24:00'
+            else:
+                stamp = t.strftime('%d.%m.%y %H:00')
+            rows.append('{}; {}'.format(stamp, value(station, substance, t)))
+            t += step
+        return '\n'.join(rows) + '\n'
+
+def handler(site):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, with Nagle's algorithm
+        # every answer on a kept alive connection would wait for the
+        # delayed ACK of the client
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            fields = dict(urllib.parse.parse_qsl(
+                self.rfile.read(length).decode('utf-8'),
+                keep_blank_values = True))
+            cookie = SimpleCookie(self.headers.get('Cookie', ''))
+            status, sid, content_type, body = site.handle(fields,
+                cookie['sid'].value if 'sid' in cookie else None)
+            if status is None:
+                # Hang up without an answer
+                self.close_connection = True
+                return
+            body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Set-Cookie', 'sid={}'.format(sid))
+            self.send_header('Content-Type',
+                '{}; charset=utf-8'.format(content_type))
+            if site.compress and 'gzip' in self.headers.get(
+                    'Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST
+    return Handler
+
+def serve(site, port = 0):
+    # Runs the stand-in in a background thread, returns the server and the
+    # URL to point the importer to
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler(site))
+    server.daemon_threads = True
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}/recherche.aspx'.format(
+        server.server_address[1])
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    class OptParser(OptionParser):
+        def format_epilog(self, formatter):
+            return self.epilog
+    parser = OptParser(epilog = u"""
+Serves a stand-in for recherche.aspx on 127.0.0.1, e.g. for
+python AirImport/importer.py --url http://127.0.0.1:8765/recherche.aspx
+""")
+    parser.add_option(
+        "-p", "--port",
+        dest = "port",
+        type = "int",
+        default = 8765,
+        help = u"Port to listen on",
+    )
+    parser.add_option(
+        "-l", "--latency",
+        dest = "latency",
+        type = "float",
+        default = 0.0,
+        help = u"Seconds every request takes at least",
+    )
+    parser.add_option(
+        "-n", "--stations",
+        dest = "stations",
+        type = "int",
+        default = 10,
+        help = u"Number of stations",
+    )
+    parser.add_option(
+        "--viewstate",
+        dest = "viewstate",
+        type = "int",
+        default = 20000,
+        help = u"Size of the ViewState in bytes",
+    )
+    parser.add_option(
+        "--failures",
+        dest = "failures",
+        type = "float",
+        default = 0.0,
+        help = u"Share of requests whose answer gets lost",
+    )
+    (options, arguments) = parser.parse_args()
+
+    site = Site(stations = options.stations, latency = options.latency,
+        viewstate = options.viewstate, failures = options.failures)
+    server, url = serve(site, options.port)
+    print('Serving {}'.format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print('{} requests'.format(site.requests))
+        server.shutdown()
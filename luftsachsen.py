@@ -1,13 +1,60 @@
 #!/usr/bin/env python3
 
-import os
+import os, time
 import datetime
 import logging, traceback
 log = logging.getLogger('uws')
 
-from AirImport import importer, converter
+from AirImport import importer, converter, store, metrics, gaps
+from AirImport.manifest import Manifest
+from AirImport.catalog import Catalog
 
-def main(data_dir, basedir, use_git = False):
+def main(data_dir, basedir, use_git = False, resume = True, processes = 1,
+        store_path = None, metrics_path = None, use_archive = False):
+    measured(metrics_path, update, data_dir, basedir, use_git, resume,
+        processes, store_path, use_archive)
+
+def daemon(data_dir, basedir, interval, use_git = False, processes = 1,
+        store_path = None, metrics_path = None, use_archive = False):
+    # Keep one session with its form state open and fetch what is new
+    # every interval seconds
+    if use_git:
+        from git import Repo
+    raw_dir = os.path.join(data_dir, 'raw')
+    os.makedirs(raw_dir, exist_ok = True)
+    manifest = Manifest.load(os.path.join(raw_dir, 'manifest.json'))
+    catalog = Catalog.load(os.path.join(raw_dir, 'catalog.json'))
+    site = None
+    while True:
+        start = time.time()
+        if site is None:
+            site = importer.LuftOnlineSiteConfig(out_dir = raw_dir,
+                basedir = basedir, manifest = manifest, catalog = catalog,
+                use_archive = use_archive)
+        try:
+            measured(metrics_path, poll, site, data_dir, basedir, use_git,
+                processes, store_path)
+        except Exception:
+            log.exception('*** Error polling, starting a new session')
+            site = None
+        time.sleep(max(0, start + interval - time.time()))
+
+def measured(metrics_path, function, *args):
+    start = time.time()
+    success = 0
+    try:
+        function(*args)
+        success = 1
+    finally:
+        # Summary of the run for cron monitoring
+        if metrics_path:
+            metrics.registry.write(metrics_path,
+                run_seconds = time.time() - start,
+                run_timestamp_seconds = start,
+                run_success = success)
+
+def update(data_dir, basedir, use_git, resume, processes, store_path,
+        use_archive):
     # Fail early if git is needed
     if use_git:
         from git import Repo
@@ -24,26 +71,105 @@ def main(data_dir, basedir, use_git = False):
         start_date = date - td
         dirs.append(os.path.join(s(start_date.year), s(start_date.month)))
         start_date = '{}-{}'.format(s(start_date.month), s(start_date.year))
+    raw_dir = os.path.join(data_dir, 'raw')
+    
+    # Download data from Umwelt Sachsen
+    with metrics.timer('phase_seconds', phase = 'import'):
+        written = importer.main(date = start_date, end_date = end_date,
+            out_dir = raw_dir, basedir = basedir, resume = resume,
+            catalog = os.path.join(raw_dir, 'catalog.json'),
+            catalog_ttl = 7 if resume else 0, use_archive = use_archive)
+    publish(data_dir, basedir, dirs, date, use_git, processes, store_path,
+        incremental = resume, written = written)
+
+def repair(data_dir, basedir, use_git, processes, store_path, use_archive):
+    # Download and convert again only the gaps found by gaps.py
+    raw_dir = os.path.join(data_dir, 'raw')
+    with metrics.timer('phase_seconds', phase = 'scan'):
+        report = gaps.scan(raw_dir, os.path.join(data_dir, 'joint'))
+        report.save(os.path.join(raw_dir, 'gaps.json'))
+    work = report.queue()
+    dirs = set(report.months())
+    written = set()
+    if work:
+        with metrics.timer('phase_seconds', phase = 'import'):
+            written = importer.main(out_dir = raw_dir, basedir = basedir,
+                resume = True, catalog = os.path.join(raw_dir, 'catalog.json'),
+                gaps = report.path, use_archive = use_archive)
+        dirs.update('{:04d}/{:02d}'.format(*period)
+            for months in work.values() for period in months)
+    publish(data_dir, basedir,
+        [os.path.join(*dir.split('/')) for dir in sorted(dirs)],
+        datetime.datetime.now(), use_git, processes, store_path,
+        incremental = False, written = written)
+
+def poll(site, data_dir, basedir, use_git, processes, store_path):
+    date = datetime.datetime.now()
+    with metrics.timer('phase_seconds', phase = 'import'):
+        touched = site.poll(date)
+    publish(data_dir, basedir,
+        [os.path.join(year, month) for year, month in sorted(touched)],
+        date, use_git, processes, store_path, written = site.written)
+
+def publish(data_dir, basedir, dirs, date, use_git, processes, store_path,
+        incremental = True, written = ()):
+    # Convert, store and commit the months in dirs (YYYY/MM), written are
+    # the raw files changed by the importer
+    changed = list(written)
     # Set taregt dirs
     (raw_dir, out_dir) = (
         os.path.join(data_dir, 'raw'), os.path.join(data_dir, 'joint'))
-    
-    # Download data from Umwelt Sachsen
-    importer.main(date = start_date, end_date = end_date,
-        out_dir = raw_dir, basedir = basedir)    
-    # Convert data to joint csv
-    for dir in dirs:
-        converter.main(data_dir = os.path.join(raw_dir, dir),
-            out_dir = os.path.join(out_dir, dir), basedir = basedir)
+    if dirs:
+        # Convert data to joint csv
+        with metrics.timer('phase_seconds', phase = 'convert'):
+            # Months in order, aggregates continue from the month before
+            for paths in converter.convert_dirs([(os.path.join(raw_dir, dir),
+                    os.path.join(out_dir, dir)) for dir in sorted(dirs)],
+                    basedir = basedir, processes = processes,
+                    incremental = incremental, aggregates = True):
+                changed.extend(paths)
+        # Load changed city files into the store
+        if store_path:
+            with metrics.timer('phase_seconds', phase = 'store'):
+                db = store.Store.open(store_path)
+                db.update(out_dir, [p for p in changed
+                    if os.path.abspath(p).startswith(
+                        os.path.abspath(out_dir) + os.sep)])
+                db.close()
     # Automatically commit and push
     if use_git:
-        for d in ('raw', 'joint'):
-            repo = Repo(data_dir)
-            index = repo.index
-            index.add([os.path.join(d, dir) for dir in dirs])
-            index.commit('Updated {} data for {}'.format(d,
-                date.strftime('%Y-%m-%d %H:%M')))
-            repo.remotes.origin.push()
+        with metrics.timer('phase_seconds', phase = 'git'):
+            commit(data_dir, changed, date)
+
+def commit(data_dir, paths, date):
+    # Stage just the files written by this run, then make a single commit
+    # and push, unless none of them differs from the last commit
+    from git import Repo
+    repo = Repo(data_dir)
+    root = os.path.realpath(repo.working_tree_dir)
+    paths = sorted(set(os.path.relpath(os.path.realpath(p), root)
+        for p in paths))
+    # Files removed are only staged if git knows them
+    missing = [p for p in paths if not os.path.lexists(os.path.join(root, p))]
+    if missing:
+        tracked = set(repo.git.ls_files('-z', '--', *missing).split('\0'))
+        paths = [p for p in paths if p not in missing or p in tracked]
+    if not paths:
+        log.info('Nothing written, no commit')
+        metrics.inc('git_commits_total', status = 'unchanged')
+        return False
+    # A thousand paths at a time keep the command lines short
+    for i in range(0, len(paths), 1000):
+        repo.git.add('--all', '--', *paths[i:i + 1000])
+    if not repo.git.diff('--cached', '--name-only'):
+        log.info('%d files written, none changed, no commit', len(paths))
+        metrics.inc('git_commits_total', status = 'unchanged')
+        return False
+    repo.git.commit('-m', 'Updated data for {}'.format(
+        date.strftime('%Y-%m-%d %H:%M')))
+    repo.remotes.origin.push()
+    metrics.inc('git_commits_total', status = 'pushed')
+    return True
 
 if __name__ == '__main__':
     from logging import StreamHandler
@@ -63,6 +189,38 @@ if __name__ == '__main__':
     parser = OptParser(epilog = """
 This script is meant to be run regularly in order to generate and push data
 automatically to the repository.
+
+Only data missing according to the manifest of the raw directory is
+downloaded, use --full to download the whole month(s) again. Likewise only
+cities whose raw files changed are converted again unless --full is given.
+Stations and substances are kept in raw/catalog.json and read from the site
+again once a week or with --full, stations without missing data are skipped.
+
+With --git the files written by the run are committed at once and pushed,
+nothing else is staged. If none of them changed, there is no commit or push.
+
+With --store FILE the joint files of all months are kept in the SQLite
+database FILE as well, see AirImport/store.py.
+
+--metrics PATH writes timings and counts of requests, downloads, parsed and
+written rows to PATH.json and PATH.prom, the latter for the textfile
+collector of the Prometheus node exporter.
+
+With --daemon MINUTES the script keeps running and polls every MINUTES with
+the same session. Only the latest rows are downloaded, using the shortest
+"last ..." period of the form that reaches back to the newest row already
+stored, and only the months touched are converted again.
+
+--repair looks for gaps in all months (see AirImport/gaps.py), downloads
+only the broken parts again and converts the months affected. The report is
+kept as raw/gaps.json.
+
+Daily and monthly means, rolling 8 and 24 hour means and exceedances of the
+EU limits of every city are kept up to date in joint/YYYY/MM/CITY.agg, see
+AirImport/aggregates.py.
+
+With --archive the raw files are kept gzip compressed and deduplicated by
+their content below raw/objects, see AirImport/archive.py.
 """)
 
     parser.add_option(
@@ -85,6 +243,57 @@ automatically to the repository.
         default = False,
         help = u"No files outside of this directory may be accessed."
     )
+
+    parser.add_option(
+        "-f", "--full",
+        action = 'store_false',
+        dest = "resume",
+        default = True,
+        help = u"Download everything again, ignoring the manifest."
+    )
+
+    parser.add_option(
+        "-j", "--jobs",
+        dest = "processes",
+        type = "int",
+        default = 1,
+        help = u"Number of processes converting months in parallel."
+    )
+
+    parser.add_option(
+        "-s", "--store",
+        dest = "store_path",
+        help = u"SQLite file to load the joint data into."
+    )
+
+    parser.add_option(
+        "-m", "--metrics",
+        dest = "metrics_path",
+        help = u"Write metrics of the run to METRICS.json and METRICS.prom."
+    )
+
+    parser.add_option(
+        "--archive",
+        action = 'store_true',
+        dest = "use_archive",
+        default = False,
+        help = u"Keep the raw files compressed in a content addressed archive."
+    )
+
+    parser.add_option(
+        "--repair",
+        action = 'store_true',
+        dest = "repair",
+        default = False,
+        help = u"Download and convert again what is missing or broken."
+    )
+
+    parser.add_option(
+        "--daemon",
+        dest = "interval",
+        type = "float",
+        help = u"Keep running, polling for new data every INTERVAL minutes."
+    )
  
  
     (options, arguments) = parser.parse_args()
@@ -92,5 +301,19 @@ automatically to the repository.
     if not options.data_dir:
         parser.error('Call with --data-dir')
 
-    main(data_dir = options.data_dir, basedir = options.basedir,
-        use_git = options.use_git)
+    if options.repair:
+        measured(options.metrics_path, repair, options.data_dir,
+            options.basedir, options.use_git, options.processes,
+            options.store_path, options.use_archive)
+    elif options.interval:
+        daemon(data_dir = options.data_dir, basedir = options.basedir,
+            interval = options.interval * 60, use_git = options.use_git,
+            processes = options.processes, store_path = options.store_path,
+            metrics_path = options.metrics_path,
+            use_archive = options.use_archive)
+    else:
+        main(data_dir = options.data_dir, basedir = options.basedir,
+            use_git = options.use_git, resume = options.resume,
+            processes = options.processes, store_path = options.store_path,
+            metrics_path = options.metrics_path,
+            use_archive = options.use_archive)